@@ -291,14 +291,20 @@ class ProcessedRule:
 
 
 class Program:
-    def __init__(self, class_name, user_constraints, rules):
+    def __init__(self, class_name, user_constraints, rules, keys=None, columnar=None):
         self.class_name = class_name
         self.user_constraints = user_constraints
         self.rules = rules
+        # declared functional dependencies, as (signature, argument positions) pairs
+        self.keys = keys if keys is not None else []
+        # signatures of the constraints declared to be kept in typed columns
+        self.columnar = columnar if columnar is not None else []
 
     def __eq__(self, other):
         return self.user_constraints == other.user_constraints \
-               and self.rules == other.rules
+               and self.rules == other.rules \
+               and self.keys == other.keys \
+               and self.columnar == other.columnar
 
     def __str__(self):
         return '\n'.join(map(str, self.rules))
@@ -310,7 +316,9 @@ class Program:
         return Program(
             self.class_name,
             self.user_constraints,
-            [rule.get_normal_form() for rule in self.rules]
+            [rule.get_normal_form() for rule in self.rules],
+            self.keys,
+            self.columnar
         )
 
     def omega_r(self):
@@ -355,4 +363,4 @@ class Program:
                 body=rule.body
             ))
 
-        return Program(self.class_name, self.user_constraints, rules)
+        return Program(self.class_name, self.user_constraints, rules, self.keys, self.columnar)
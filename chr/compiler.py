@@ -1,5 +1,5 @@
 import ast
-from typing import List, Dict, Any, Tuple, Set, Union, Callable, Optional
+from typing import List, Dict, Any, Tuple, Set, Union, Callable, Optional, Iterable
 
 from ast_decompiler import decompile
 from pprintast import pprintast
@@ -75,6 +75,10 @@ BUILTIN_TYPES = {
     "memoryview"
 }
 
+# types of constants in head patterns, by which constraints are partitioned in hash indexes,
+# and occurrences are grouped in dispatch tables (see chr.runtime.dispatch_key)
+DISPATCH_TYPES = (str, int, float, bool)
+
 
 class CHRCompilationError(RuntimeError):
     def __init__(self, message):
@@ -198,11 +202,13 @@ def gen_new_call(var_name: str) -> ast.Assign:
     )
 
 
-def gen_insert_call(index_var: str, constraint_var: str) -> Statement:
+def gen_insert_call(symbol_id: int, arity: int) -> Statement:
+    """Generates the insertion of the constraint in an activation procedure into the store"""
     return gen_expr(gen_call(
         gen_attribute(gen_self(), "chr", "insert"),
-        gen_name(index_var),
-        gen_name(constraint_var)
+        gen_tuple(gen_constant(symbol_id), gen_starred(gen_name("args")))
+        if arity > 0 else gen_tuple(gen_constant(symbol_id)),
+        gen_name("index")
     ))
 
 
@@ -353,6 +359,25 @@ def gen_comparison(op: str, lhs_ast: Expression, rhs_ast: Expression) -> Express
     )
 
 
+def gen_bound_comparison(op: str, lhs_ast: Expression, rhs_ast: Expression) -> Expression:
+    return gen_and(
+        gen_call("is_bound", lhs_ast),
+        gen_call("is_bound", rhs_ast),
+        gen_comparison(op, gen_call("get_value", lhs_ast), gen_call("get_value", rhs_ast))
+    )
+
+
+def gen_identity_check(lhs_ast: Expression, rhs_ast: Expression) -> Expression:
+    return gen_or(
+        gen_and(
+            gen_call("is_bound", lhs_ast),
+            gen_call("is_bound", rhs_ast),
+            gen_is(lhs_ast, rhs_ast)
+        ),
+        gen_is(lhs_ast, rhs_ast)
+    )
+
+
 def gen_kill_call(index_name: str) -> Statement:
     return gen_expr(
         gen_call(
@@ -608,14 +633,7 @@ def compile_is(
 
     return gen_raise_on_false(
         gen_call(exception_name),
-        gen_or(
-            gen_and(
-                gen_call("is_bound", lhs_ast),
-                gen_call("is_bound", rhs_ast),
-                gen_is(lhs_ast, rhs_ast)
-            ),
-            gen_is(lhs_ast, rhs_ast)
-        ),
+        gen_identity_check(lhs_ast, rhs_ast),
         before_raise=[] if in_guard else [gen_commit()]
     )
 
@@ -639,11 +657,7 @@ def compile_comparisons(
 
     return gen_raise_on_false(
         gen_call(exception_name),
-        gen_and(
-            gen_call("is_bound", lhs_ast),
-            gen_call("is_bound", rhs_ast),
-            gen_comparison(op, gen_call("get_value", lhs_ast), gen_call("get_value", rhs_ast))
-        ),
+        gen_bound_comparison(op, lhs_ast, rhs_ast),
         before_raise=[] if in_guard else [gen_commit()]
     )
 
@@ -747,6 +761,7 @@ def compile_misc_builtin(
 def compile_chr_constraint(
         name_gen: NameGenerator,
         term: Term,
+        symbol_id: int,
         known_variables: Dict[str, Expression]
 ) -> List[Statement]:
     """Compiles a CHR-Constraint in the body, where
@@ -756,45 +771,38 @@ def compile_chr_constraint(
     is translated to
 
         _id_j = self.chr.new()
-        _c_i = ("c/n", t1', t2', ..., tn')
-        self.chr.insert(_c_i, _id_j)
-        self.__activate_c_n(id_j, t1', t2', ..., t3')
+        self.__activate_c_n(id_j, t1', t2', ..., tn')
 
-    where ti' = compile_term(ti)
+    where ti' = compile_term(ti). The activation procedure inserts the constraint into
+    the store (see compile_activate_procedure).
     """
     var_names = vars(term)
     if not all(v in known_variables for v in var_names):
         raise CHRCompilationError(f"Variables {var_names - set(known_variables.keys())} not known.")
 
     id_var = name_gen.new_name(prefix="id")
-    c_var = name_gen.new_name(prefix="c")
 
     id_var_ast = gen_name(id_var)
-    c_var_ast = gen_name(c_var)
 
     known_variables[id_var] = id_var_ast
-    known_variables[c_var] = c_var_ast
 
     arg_asts = [compile_term(sub_term, known_variables) for sub_term in term.params]
 
     return [
         gen_new_call(id_var),
-        gen_assign(
-            [c_var_ast],
-            gen_tuple(
-                gen_constant(f'{term.symbol}/{term.arity}'),
-                *arg_asts
-            )
-        ),
-        gen_insert_call(c_var, id_var),
-        gen_activate_call(id_var, term.symbol, term.arity, *arg_asts)  # TODO optimize
+        gen_activate_call(
+            id_var,
+            term.symbol,
+            term.arity,
+            *arg_asts
+        )
     ]
 
 
 def compile_rule_body(
         name_gen: NameGenerator,
         killed_constraints: Set[str],
-        known_chr_constraints: Set[str],
+        known_chr_constraints: Dict[str, int],
         known_variables: Dict[str, Expression],
         body_constraints: List[Term]
 ) -> List[Statement]:
@@ -803,8 +811,14 @@ def compile_rule_body(
 
     for body_constraint in body_constraints:
         if isinstance(body_constraint, Term):
-            if f"{body_constraint.symbol}/{body_constraint.arity}" in known_chr_constraints:
-                constraints += compile_chr_constraint(name_gen, body_constraint, known_variables)
+            signature = f"{body_constraint.symbol}/{body_constraint.arity}"
+            if signature in known_chr_constraints:
+                constraints += compile_chr_constraint(
+                    name_gen,
+                    body_constraint,
+                    known_chr_constraints[signature],
+                    known_variables
+                )
             elif body_constraint.symbol == "=":
                 constraints += compile_unify(body_constraint.params[0], body_constraint.params[1], known_variables)
                 constraints.append(gen_commit())
@@ -864,6 +878,14 @@ def compile_match(
 ) -> List[Expression]:
     conditions = []
 
+    # ground structured patterns are compared in one call instead of node by node;
+    # as == does not tell e.g. 1, 1.0 and True apart, the exact types are checked afterwards
+    if isinstance(pattern, (dict, tuple, list)) and not vars(pattern):
+        return [
+            gen_call("equal", value_ast, compile_term(pattern, known_vars)),
+            *compile_element_type_checks(value_ast, pattern)
+        ]
+
     if not isinstance(pattern, Var):
         conditions.append(gen_type_check(value_ast, pattern))
 
@@ -901,6 +923,23 @@ def compile_match(
     return conditions
 
 
+def compile_element_type_checks(value_ast: Expression, pattern: Any) -> List[Expression]:
+    """
+    Compiles the exact type checks of the elements of a value, which is known to be equal
+    to the given ground pattern (see compile_match). The type of the value itself is
+    already checked by equal. Elements equal to None are None.
+    """
+    conditions = []
+    for index, sub_term in enumerate(pattern) if isinstance(pattern, (tuple, list)) else pattern.items():
+        if sub_term is None:
+            continue
+        element_ast = gen_subscript_index(value_ast, gen_constant(index))
+        conditions.append(gen_type_check(element_ast, sub_term))
+        if isinstance(sub_term, (dict, tuple, list)):
+            conditions += compile_element_type_checks(element_ast, sub_term)
+    return conditions
+
+
 def compile_guard_constraint(
         name_gen: NameGenerator,
         constraint: Term,
@@ -942,14 +981,134 @@ def compile_guard_constraint(
     return compile_misc_builtin(constraint, known_variables, in_guard=True)
 
 
+def is_pure_term(term: Any) -> bool:
+    """
+    :param term: a builtin term
+    :return: True, if the compiled term only reads values, i.e. it consists of variables,
+        constants, comparisons and arithmetic operations
+    """
+    if isinstance(term, dict):
+        return all(is_pure_term(k) and is_pure_term(v) for k, v in term.items())
+    if isinstance(term, (tuple, list)):
+        return all(is_pure_term(t) for t in term)
+    if isinstance(term, Term):
+        if term.symbol in BUILTIN_TYPES and not term.params:
+            return True
+        return (
+            term.symbol in BUILTIN_COMPARISON_OPERATOR_TRANSLATIONS or
+            term.symbol in BUILTIN_ARITH_OPERATOR_TRANSLATION
+        ) and all(is_pure_term(t) for t in term.params)
+    return True
+
+
+# comparisons, that cannot raise for any two values (apart from ordering incomparable ones)
+EARLY_GUARD_COMPARISONS = {"==", "!=", "<", "<=", ">", ">=", "is", "is not"}
+
+
+def is_plain_term(term: Any) -> bool:
+    """
+    :param term: a builtin term
+    :return: True, if evaluating the compiled term cannot raise, i.e. it is a variable,
+        an atomic constant or a builtin type
+    """
+    if isinstance(term, Term):
+        return term.symbol in BUILTIN_TYPES and not term.params
+    return not isinstance(term, (dict, tuple, list))
+
+
+def is_early_guard_constraint(constraint: Term) -> bool:
+    """
+    Guard constraints, that neither bind variables nor call user code, cannot raise, and
+    whose result cannot change from true to false when variables get bound, can be checked
+    as soon as their variables are matched, even if no partner constraints are found then.
+    These are comparisons and 'is_bound' of variables and constants: 'fresh', '=' and
+    function calls have side effects, 'not' is not monotonic, and arithmetic or 'in'
+    may raise, e.g. on a division by zero or an unbound variable.
+    :param constraint: guard constraint
+    :return: True, if the guard constraint can be moved out of the guarded body
+    """
+    if not isinstance(constraint, Term):
+        return False
+    return (
+        constraint.symbol in EARLY_GUARD_COMPARISONS or
+        constraint.symbol == "is_bound"
+    ) and all(is_plain_term(t) for t in constraint.params)
+
+
+def term_size(term: Any) -> int:
+    if isinstance(term, dict):
+        return 1 + sum(term_size(k) + term_size(v) for k, v in term.items())
+    if isinstance(term, (tuple, list)):
+        return 1 + sum(term_size(t) for t in term)
+    if isinstance(term, Term):
+        return 1 + sum(term_size(t) for t in term.params)
+    return 1
+
+
+def schedule_guard(
+        guard_constraints: List[Term],
+        known_variables: Dict[str, Expression],
+        future_matchings: List[Term]
+) -> Tuple[List[Term], List[Term]]:
+    """
+    Picks the guard constraints, that can be checked in the current loop already, i.e.
+    constraints from the leading run of early guard constraints (see is_early_guard_constraint),
+    whose variables are known, and not matched against patterns in inner loops.
+    The picked constraints are ordered by size, cheapest first. All other constraints stay
+    in their original order.
+    :param guard_constraints: guard constraints not checked yet
+    :param known_variables: variables known in the current loop
+    :param future_matchings: matchings compiled in inner loops
+    :return: the constraints to check now, and the remaining guard constraints
+    """
+    pending_vars = set().union(*(vars(m) for m in future_matchings))
+
+    prefix_length = 0
+    while (
+            prefix_length < len(guard_constraints) and
+            is_early_guard_constraint(guard_constraints[prefix_length])
+    ):
+        prefix_length += 1
+
+    early = []
+    later = []
+    for i, constraint in enumerate(guard_constraints):
+        constraint_vars = vars(constraint)
+        if (
+                i < prefix_length and
+                constraint_vars.issubset(known_variables.keys()) and
+                not constraint_vars.intersection(pending_vars)
+        ):
+            early.append(constraint)
+        else:
+            later.append(constraint)
+
+    return sorted(early, key=term_size), later
+
+
+def compile_guard_condition(constraint: Term, known_variables: Dict[str, Expression]) -> Expression:
+    """Compiles an early guard constraint (see is_early_guard_constraint) into a condition"""
+    symbol = constraint.symbol
+    params = constraint.params
+    if symbol == "is_bound":
+        return gen_call("is_bound", compile_term(params[0], known_variables))
+
+    lhs_ast = compile_term(params[0], known_variables)
+    rhs_ast = compile_term(params[1], known_variables)
+    if symbol == "is":
+        return gen_identity_check(lhs_ast, rhs_ast)
+
+    return gen_bound_comparison(symbol, lhs_ast, rhs_ast)
+
+
 def compile_guarded_body(
         name_gen: NameGenerator,
         killed_constraints: Set[str],
-        known_chr_constraints: Set[str],
+        known_chr_constraints: Dict[str, int],
         known_variables: Dict[str, Expression],
         guard_constraints: List[Term],
         body_constraints: List[Term],
-        history_entry: Tuple[Expression, ...]
+        history_entry: Tuple[Expression, Expression]
 ) -> Statement:
     guard_statements = [
         stmt
@@ -973,8 +1132,7 @@ def compile_guarded_body(
         return gen_guard_try_catch(
             *dead_code_elimination(guard_statements),
             *gen_if(
-                gen_not(gen_call(gen_attribute(gen_self(), "chr", "in_history"), *history_entry)),
-                gen_expr(gen_call(gen_attribute(gen_self(), "chr", "add_to_history"), *history_entry)),
+                gen_call(gen_attribute(gen_self(), "chr", "add_to_history"), *history_entry),
                 gen_commit(),
                 *compile_rule_body(
                     name_gen,
@@ -988,17 +1146,22 @@ def compile_guarded_body(
 
 
 def compile_alive_checks(
-        rule_name: str,
+        rule_id: int,
+        history_ids: List[str],
         name_gen: NameGenerator,
         total_head_constraints: int,
         killed_constraints: Set[str],
-        known_chr_constraints: Set[str],
+        known_chr_constraints: Dict[str, int],
         known_variables: Dict[str, Expression],
         guard_constraints: List[Term],
-        body_constraints: List[Term]
+        body_constraints: List[Term],
+        unchecked_ids: Set[str]
 ) -> List[Statement]:
     return gen_if(
-        gen_and(*(gen_alive_call(f"id_{i}") for i in range(0, total_head_constraints))),
+        gen_and(*(
+            gen_alive_call(f"id_{i}") for i in range(0, total_head_constraints)
+            if f"id_{i}" not in unchecked_ids
+        )),
         compile_guarded_body(
             name_gen,
             killed_constraints,
@@ -1007,39 +1170,86 @@ def compile_alive_checks(
             guard_constraints,
             body_constraints,
             (
-                gen_constant(rule_name),
-                *(known_variables[f"id_{i}"] for i in range(0, total_head_constraints))
+                gen_constant(rule_id),
+                gen_tuple(*(known_variables[i] for i in history_ids))
+                if len(history_ids) > 1 else known_variables[history_ids[0]]
             )
         )
     )
 
 
+def lookup_keys(head: HeadConstraint, matchings: List[Term], known: Iterable[str]) -> Dict[int, Any]:
+    """
+    Determines the arguments of a partner constraint, that can be looked up in a hash index:
+    arguments matched against known variables, or, if there are none, arguments matched
+    against constants (see DISPATCH_TYPES), which partition the constraints by their tags.
+    :param head: head constraint of the loop
+    :param matchings: matchings not compiled yet
+    :param known: variables known before the loop starts
+    :return: the keys (variables or constants) by argument position
+    """
+    known = set(known)
+    keys = {}
+    for matching in matchings:
+        lhs, rhs = matching.params
+        if not isinstance(lhs, Var) or not isinstance(rhs, Var):
+            continue
+        if lhs.name in head.params and rhs.name in known:
+            keys[head.params.index(lhs.name)] = rhs
+        elif rhs.name in head.params and lhs.name in known:
+            keys[head.params.index(rhs.name)] = lhs
+
+    if keys:
+        return keys
+
+    for matching in matchings:
+        lhs, rhs = matching.params
+        if isinstance(lhs, Var) and lhs.name in head.params and type(rhs) in DISPATCH_TYPES:
+            keys[head.params.index(lhs.name)] = rhs
+    return keys
+
+
 def compile_match_loops(
-        rule_name: str,
+        rule_id: int,
+        history_ids: List[str],
         name_gen: NameGenerator,
         current_head_constraint: int,
         killed_constraints: Set[str],
-        known_chr_constraints: Set[str],
+        known_chr_constraints: Dict[str, int],
         known_variables: Dict[str, Expression],
         matched_symbols: Dict[str, List[str]],
+        indexes: Set[Tuple[str, Tuple[int, ...]]],
         head_constraints: List[HeadConstraint],
         matchings: List[Term],
         guard_constraints: List[Term],
-        body_constraints: List[Term]
+        body_constraints: List[Term],
+        keys: Set[Tuple[str, Tuple[int, ...]]],
+        unchecked_ids: Set[str]
 ) -> List[Statement]:
+    """
+    Compiles the nested loops over the partner constraints of an occurrence.
+    A partner with a functional dependency (see functional_dependencies), whose key
+    arguments are all looked up, is fetched with a single lookup instead of a loop. As the
+    body is then reached at most once per constraint fetched that way, their alive checks
+    are left out, unless a loop follows.
+    :param keys: functional dependencies, as (signature, key positions) pairs
+    :param unchecked_ids: ids of the single lookups since the last loop
+    """
     if not head_constraints:
         if matchings:
             raise CHRCompilationError(f"There are uncompiled matchings: {matchings}")
 
         return compile_alive_checks(
-            rule_name,
+            rule_id,
+            history_ids,
             name_gen,
             current_head_constraint,
             killed_constraints,
             known_chr_constraints,
             known_variables,
             guard_constraints,
-            body_constraints
+            body_constraints,
+            unchecked_ids
         )
 
     c_var_name = f"c_{current_head_constraint}"
@@ -1053,6 +1263,18 @@ def compile_match_loops(
 
     current, *next_constraints = head_constraints
 
+    symbol = f'{current.symbol}/{current.arity}'
+
+    # Arguments of the current head constraint, which are matched against variables known
+    # before the loop starts, can be looked up in a hash index instead of iterating
+    # over all constraints with the same symbol.
+    index_keys = {
+        position: compile_term(key, known_variables)
+        for position, key in lookup_keys(current, matchings, known_variables.keys()).items()
+    }
+
+    index_positions = tuple(sorted(index_keys.keys()))
+
     for i, param in enumerate(current.params):
         known_variables[param] = gen_subscript_index(c_var_ast, gen_constant(i + 1))
 
@@ -1079,10 +1301,12 @@ def compile_match_loops(
             known_variables
         )
 
-    symbol = f'{current.symbol}/{current.arity}'
+    early_guard, guard_constraints = schedule_guard(guard_constraints, known_variables, future_matchings)
+    matching_condition += [compile_guard_condition(gc, known_variables) for gc in early_guard]
+
     different_symbols = []
     if symbol in matched_symbols:
-        different_symbols = matched_symbols[symbol]
+        different_symbols = list(matched_symbols[symbol])
     checks = [
         gen_comparison("!=", index_var_ast, gen_name(other))
         for other in different_symbols
@@ -1095,37 +1319,195 @@ def compile_match_loops(
     if not current.kept:
         killed_constraints.add(index_var_name)
 
+    single = any(
+        signature == symbol and set(key).issubset(index_positions)
+        for signature, key in keys
+    )
+
+    if single:
+        inner = compile_match_loops(
+            rule_id,
+            history_ids,
+            name_gen,
+            current_head_constraint + 1,
+            killed_constraints,
+            known_chr_constraints,
+            known_variables,
+            matched_symbols,
+            indexes,
+            next_constraints,
+            future_matchings,
+            guard_constraints,
+            body_constraints,
+            keys,
+            unchecked_ids | {index_var_name}
+        )
+
+        if index_positions:
+            indexes.add((symbol, index_positions))
+        lookup_args = {
+            "index": gen_tuple(*(gen_constant(i) for i in index_positions)),
+            "key": gen_tuple(*(index_keys[i] for i in index_positions))
+        } if index_positions else {}
+        if different_symbols:
+            lookup_args["exclude"] = gen_tuple(*(gen_name(other) for other in different_symbols))
+
+        return [
+            gen_assign(
+                [gen_tuple(index_var_ast, c_var_ast)],
+                gen_call(
+                    gen_attribute(gen_self(), "chr", "get_single"),
+                    symbol=gen_constant(known_chr_constraints[symbol]),
+                    **lookup_args
+                )
+            ),
+            *gen_if(
+                gen_and(gen_comparison("is not", index_var_ast, gen_constant(None)), *matching_condition),
+                *inner
+            )
+        ]
+
+    if index_positions:
+        indexes.add((symbol, index_positions))
+        iterator = gen_call(
+            gen_attribute(gen_self(), "chr", "get_iterator"),
+            symbol=gen_constant(known_chr_constraints[symbol]),
+            index=gen_tuple(*(gen_constant(i) for i in index_positions)),
+            key=gen_tuple(*(index_keys[i] for i in index_positions))
+        )
+    else:
+        iterator = gen_call(
+            gen_attribute(gen_self(), "chr", "get_iterator"),
+            symbol=gen_constant(known_chr_constraints[symbol])
+        )
+
     return [gen_for_loop(
         gen_tuple(index_var_ast, c_var_ast),
-        gen_call(
-            gen_attribute(gen_self(), "chr", "get_iterator"),
-            fix=gen_constant(True),
-            symbol=gen_constant(symbol)
-        ),
+        iterator,
         *gen_if(
             gen_and(*checks, *matching_condition) if matching_condition or checks else gen_constant(True),
             *compile_match_loops(
-                rule_name,
+                rule_id,
+                history_ids,
                 name_gen,
                 current_head_constraint + 1,
                 killed_constraints,
                 known_chr_constraints,
                 known_variables,
                 matched_symbols,
+                indexes,
                 next_constraints,
                 future_matchings,
                 guard_constraints,
-                body_constraints
+                body_constraints,
+                keys,
+                set()
             )
         )
     )]
 
 
+def matched_variables(
+        matchings: List[Term],
+        known: Set[str],
+        pending: Set[str]
+) -> Set[str]:
+    """
+    Determines the variables bound by the matchings, that are checked once the given
+    variables are known, the same way compile_match_loops does.
+    :param matchings: ask_match terms
+    :param known: variables known so far
+    :param pending: parameters of the head constraints, that are matched later
+    :return: known, extended by the variables of the patterns of these matchings
+    """
+    known = set(known)
+    changed = True
+    while changed:
+        changed = False
+        for matching in matchings:
+            lhs, rhs = matching.params
+            pattern_vars = vars(rhs)
+            if (
+                    vars(lhs).issubset(known) and
+                    not pattern_vars.intersection(pending) and
+                    not pattern_vars.issubset(known)
+            ):
+                known |= pattern_vars
+                changed = True
+    return known
+
+
+def plan_join(occurrence_scheme: OccurrenceScheme) -> List[Tuple[int, HeadConstraint, Tuple[int, ...], int]]:
+    """
+    Chooses the order, in which the partner constraints of an occurrence are matched.
+    The next partner is the one with the lowest estimated cost, given the variables known
+    from the active constraint and the partners before it:
+        - a partner with arguments equal to known variables is looked up in a hash index;
+          the more arguments are indexed, the fewer candidates are visited
+        - a partner with arguments matched against constants or known variables is scanned,
+          but candidates are pruned right away
+        - any other partner is scanned without pruning, i.e. it multiplies the number of
+          candidates of the following loops
+    On equal costs, the partners keep their order in the rule head.
+    :param occurrence_scheme: occurrence scheme
+    :return: the partners in join order, as (head position, head constraint, indexed
+        argument positions, number of matchings checked right after the lookup)
+    """
+    _, head = occurrence_scheme.occurring_constraint
+    matchings = occurrence_scheme.matching
+    remaining = list(occurrence_scheme.other_constraints)
+    pending = set().union(*(vars(c) for _, c in remaining))
+    known = matched_variables(matchings, set(head.params), pending)
+
+    plan = []
+    while remaining:
+        best = None
+        for idx, candidate in remaining:
+            params = set(candidate.params)
+            others = pending - params
+            index_positions = set(lookup_keys(candidate, matchings, known))
+            filters = sum(
+                1 for matching in matchings
+                if vars(matching).intersection(params) and
+                vars(matching).issubset(known | params) and
+                not vars(matching.params[1]).intersection(others)
+            ) - len(index_positions)
+            cost = (-len(index_positions), -filters)
+            if best is None or cost < best[0]:
+                best = cost, idx, candidate, tuple(sorted(index_positions)), filters
+
+        _, idx, candidate, index_positions, filters = best
+        plan.append((idx, candidate, index_positions, filters))
+        remaining = [(i, c) for i, c in remaining if i != idx]
+        pending = set().union(*(vars(c) for _, c in remaining))
+        known = matched_variables(matchings, known | set(candidate.params), pending)
+
+    return plan
+
+
+def format_join_plan(occurrence_scheme: OccurrenceScheme) -> str:
+    """
+    :param occurrence_scheme: occurrence scheme
+    :return: the join order chosen by plan_join, one line per partner
+    """
+    head_idx, head = occurrence_scheme.occurring_constraint
+    lines = [f"{occurrence_scheme.rule_name}: active {head.symbol}/{head.arity} (head {head_idx})"]
+    for idx, partner, index_positions, filters in plan_join(occurrence_scheme):
+        access = f"index on {list(index_positions)}" if index_positions else "scan"
+        lines.append(
+            f"    {partner.symbol}/{partner.arity} (head {idx}): {access}, {filters} matching(s)"
+        )
+    return "\n".join(lines)
+
+
 def compile_occurrence(
         occurrence_scheme: OccurrenceScheme,
-        known_chr_constraints: Set[str]
+        known_chr_constraints: Dict[str, int],
+        indexes: Set[Tuple[str, Tuple[int, ...]]],
+        rule_id: int,
+        keys: Set[Tuple[str, Tuple[int, ...]]] = frozenset()
 ) -> Tuple[str, int, Statement]:
-    _, head = occurrence_scheme.occurring_constraint
+    head_idx, head = occurrence_scheme.occurring_constraint
     known_variables = {
         v: gen_name(v) for v in head.params
     }
@@ -1138,6 +1520,15 @@ def compile_occurrence(
 
     proc_name = f"__{head.symbol}_{head.arity}_{head.occurrence_idx}"
 
+    partners = [(idx, partner) for idx, partner, _, _ in plan_join(occurrence_scheme)]
+
+    # The ids in propagation history entries are ordered by the position of the constraints
+    # in the rule head, so that all occurrences of a rule share the same entries.
+    head_ids = {head_idx: "id_0"}
+    for i, (idx, _) in enumerate(partners):
+        head_ids[idx] = f"id_{i + 1}"
+    history_ids = [head_ids[idx] for idx in sorted(head_ids.keys())]
+
     viable_matchings = []
     future_matchings = []
 
@@ -1160,6 +1551,11 @@ def compile_occurrence(
             known_variables
         )
 
+    early_guard, guard_constraints = schedule_guard(
+        occurrence_scheme.guard, known_variables, future_matchings
+    )
+    matching_condition += [compile_guard_condition(gc, known_variables) for gc in early_guard]
+
     return head.symbol, head.arity, gen_func_def(
         proc_name,
         ast.arguments(
@@ -1177,26 +1573,255 @@ def compile_occurrence(
             gen_return(gen_constant(False))
         ) if matching_condition else [gen_pass()]),
         *compile_match_loops(
-            occurrence_scheme.rule_name,
+            rule_id,
+            history_ids,
             NameGenerator(),
             1,
             killed_constraints,
             known_chr_constraints,
             known_variables,
             matched_symbols,
-            list(c for _, c in occurrence_scheme.other_constraints),
+            indexes,
+            list(c for _, c in partners),
             future_matchings,
-            occurrence_scheme.guard,
-            occurrence_scheme.body
+            guard_constraints,
+            occurrence_scheme.body,
+            keys,
+            set()
         ),
         gen_return(gen_constant(False))
     )
 
 
-def compile_activate_procedure(symbol: str, arity: int, occurrences: List[ast.FunctionDef]) -> Statement:
+def functional_dependencies(program: Program) -> Set[Tuple[str, Tuple[int, ...]]]:
+    """
+    Collects the functional dependencies of a program, i.e. argument positions, such that
+    there is at most one constraint per value of the arguments at these positions.
+    Only declared dependencies ("keys c/3(1).") are used: a rule like
+    "c($K, $_) \\ c($K, $_) <=> ..." does not establish one, as duplicates coexist in the
+    store until it fired, and other occurrences of the new constraint may run before.
+    :param program: program in omega_r form
+    :return: set of (signature, key positions) pairs
+    :raises CHRCompilationError: a key is declared for an undeclared constraint, or at an
+        argument position beyond its arity
+    """
+    for signature, positions in program.keys:
+        if signature not in program.user_constraints:
+            raise CHRCompilationError(f"Key constraint {signature} not declared.")
+        arity = int(signature.rsplit('/', 1)[1])
+        if any(position >= arity for position in positions):
+            raise CHRCompilationError(f"Key positions {positions} out of range for {signature}.")
+
+    return {(signature, tuple(positions)) for signature, positions in program.keys}
+
+
+def occurrence_dependencies(occurrence_scheme: OccurrenceScheme) -> Set[int]:
+    """
+    Determines the argument positions of the occurring constraint, whose bindings can make
+    the occurrence applicable, i.e. the positions of the variables used in the matching
+    or the guard. Bindings of other arguments cannot change the outcome of the occurrence;
+    bindings of the arguments of the other head constraints wake those constraints.
+    :param occurrence_scheme: occurrence scheme
+    :return: set of argument positions (starting at 0)
+    """
+    _, head = occurrence_scheme.occurring_constraint
+    used = set().union(*(vars(c) for c in occurrence_scheme.matching + occurrence_scheme.guard))
+    return {i for i, param in enumerate(head.params) if param in used}
+
+
+def occurrence_observes(occurrence_scheme: OccurrenceScheme) -> bool:
+    """
+    Determines, whether the occurring constraint has to be in the store, when the occurrence
+    is tried: if it is kept, it can be found by the constraints added in the body, and a
+    guard with side effects (e.g. bindings waking other constraints) may look it up, too.
+    Otherwise, it is deleted before anything can look it up, or the rule does not fire.
+    :param occurrence_scheme: occurrence scheme
+    :return: True, if the constraint has to be inserted before the occurrence
+    """
+    _, head = occurrence_scheme.occurring_constraint
+    if head.kept:
+        return True
+    return not all(
+        isinstance(constraint, Term) and (
+            constraint.symbol == "fresh" or
+            is_pure_term(constraint) or
+            constraint.symbol in {"is", "is_bound", "not", "and", "or"} and
+            all(is_pure_term(t) for t in constraint.params)
+        )
+        for constraint in occurrence_scheme.guard
+    )
+
+
+def dispatch_tag(pattern: Any) -> Optional[tuple]:
+    """
+    :param pattern: pattern an argument of a head constraint is matched against
+    :return: the key chr.runtime.dispatch_key computes for all values matching the pattern,
+        or None, if values with different keys can match it
+    """
+    if type(pattern) in DISPATCH_TYPES:
+        return type(pattern), pattern
+    # ground patterns are compared with equal, which dereferences nested variables
+    if type(pattern) in (tuple, list) and pattern and type(pattern[0]) in DISPATCH_TYPES and vars(pattern):
+        return type(pattern), type(pattern[0]), pattern[0]
+    return None
+
+
+def occurrence_tags(occurrence_scheme: OccurrenceScheme) -> Dict[int, tuple]:
+    """
+    :param occurrence_scheme: occurrence scheme
+    :return: the dispatch tags (see dispatch_tag) of the arguments of the occurring constraint
+    """
+    _, head = occurrence_scheme.occurring_constraint
+    tags = {}
+    for matching in occurrence_scheme.matching:
+        lhs, rhs = matching.params
+        if isinstance(lhs, Var) and lhs.name in head.params:
+            tag = dispatch_tag(rhs)
+            if tag is not None:
+                tags[head.params.index(lhs.name)] = tag
+    return tags
+
+
+def dispatch_position(tags: List[Dict[int, tuple]]) -> Optional[int]:
+    """
+    :param tags: dispatch tags of the occurrences of a constraint
+    :return: the argument position tagged in most occurrences, or None, if dispatching
+        cannot skip any occurrence
+    """
+    counts = {}
+    for occurrence_tags in tags:
+        for position in occurrence_tags:
+            counts[position] = counts.get(position, 0) + 1
+    if not counts or len(tags) < 2:
+        return None
+    return min(counts, key=lambda position: (-counts[position], position))
+
+
+def compile_dispatch_table(
+        symbol: str,
+        arity: int,
+        occurrences: List[ast.FunctionDef],
+        tags: List[Dict[int, tuple]],
+        position: int,
+        observing: List[bool],
+        symbol_id: int
+) -> List[Statement]:
+    """
+    Compiles the class attributes, by which the activation procedure looks up the occurrences
+    that can match the argument at the given position, in their original order:
+        __dispatch_c_n = {tag: (occurrences with this tag or no tag), ..., None: (all occurrences)}
+        __untagged_c_n = (occurrences without tag)
+    Arguments without a key (see chr.runtime.dispatch_key), e.g. unbound variables, may be
+    bound by the body of an earlier occurrence, so they are looked up under None, and
+    all occurrences are tried.
+    Each entry contains the procedure __store_c_n, which inserts the constraint into the
+    store, before the first occurrence observing it, or at the end.
+    """
+    store_name = f"__store_{symbol}_{arity}"
+
+    def with_store(names: List[str]) -> List[str]:
+        observers = [i for i, name in enumerate(names) if observing_names[name]]
+        position_of_store = observers[0] if observers else len(names)
+        return names[:position_of_store] + [store_name] + names[position_of_store:]
+
+    observing_names = {proc.name: observes for proc, observes in zip(occurrences, observing)}
+
+    def gen_tag(tag: tuple) -> Expression:
+        return gen_tuple(*(
+            gen_name(part.__name__) if isinstance(part, type) else gen_constant(part)
+            for part in tag
+        ))
+
+    table = {}
+    for occurrence_tags in tags:
+        if position in occurrence_tags:
+            table.setdefault(occurrence_tags[position], [])
+
+    for tag, procedures in table.items():
+        procedures.extend(
+            proc.name for proc, occurrence_tags in zip(occurrences, tags)
+            if occurrence_tags.get(position, tag) == tag
+        )
+
+    untagged = [proc.name for proc, occurrence_tags in zip(occurrences, tags) if position not in occurrence_tags]
+
+    store_procedure = gen_func_def(
+        store_name,
+        ast.arguments(
+            args=[
+                ast.arg(arg="self", annotation=None),
+                ast.arg(arg="index", annotation=None)
+            ],
+            vararg=ast.arg(arg="args", annotation=None),
+            defaults=[],
+            kwarg=None
+        ),
+        gen_insert_call(symbol_id, arity),
+        gen_return(gen_constant(False))
+    )
+
+    return [
+        store_procedure,
+        gen_assign(
+            [gen_name(f"__dispatch_{symbol}_{arity}")],
+            gen_dict({
+                **{
+                    gen_tag(tag): gen_tuple(*(gen_name(name) for name in with_store(procedures)))
+                    for tag, procedures in table.items()
+                },
+                gen_constant(None): gen_tuple(*(gen_name(name) for name in with_store(
+                    [proc.name for proc in occurrences]
+                )))
+            })
+        ),
+        gen_assign(
+            [gen_name(f"__untagged_{symbol}_{arity}")],
+            gen_tuple(*(gen_name(name) for name in with_store(untagged)))
+        )
+    ]
+
+
+def position_mask(positions: Iterable[int]) -> int:
+    return sum(1 << i for i in positions)
+
+
+def compile_activate_procedure(
+        symbol: str,
+        arity: int,
+        occurrences: List[ast.FunctionDef],
+        dependencies: List[Set[int]],
+        observing: List[bool],
+        symbol_id: int,
+        position: Optional[int] = None
+) -> Statement:
+    """
+    Compiles the procedure trying the occurrences of a newly added constraint.
+    If a dispatch position is given, only the occurrences from the dispatch table entry
+    (see compile_dispatch_table) of the argument at this position are tried.
+
+    The constraint is only inserted into the store right before the first occurrence,
+    that can observe it (see occurrence_observes), or after the last one. Until then,
+    it can only be removed, without ever being stored.
+    """
     proc_name: str = f"__activate_{symbol}_{arity}"
 
-    if occurrences:
+    if occurrences and position is not None:
+        occurrence_tries: List[Statement] = [gen_for_loop(
+            gen_name("occurrence"),
+            gen_call(
+                gen_attribute(gen_self(), f"__dispatch_{symbol}_{arity}", "get"),
+                gen_call(
+                    "dispatch_key",
+                    gen_call("get_value", gen_subscript_index(gen_name("args"), gen_constant(position)))
+                ),
+                gen_attribute(gen_self(), f"__untagged_{symbol}_{arity}")
+            ),
+            *gen_if(
+                gen_call("occurrence", gen_self(), gen_name("index"), gen_starred(gen_name("args"))),
+                gen_return(gen_constant(True))
+            )
+        )]
+    elif occurrences:
         args_ast = [gen_starred(gen_name("args"))] if arity > 0 else []
         occurrence_calls: List[Expression] = [
 
@@ -1208,15 +1833,21 @@ def compile_activate_procedure(symbol: str, arity: int, occurrences: List[ast.Fu
             for proc in occurrences
         ]
 
-        occurrence_tries: List[Statement] = [
-            stmt
-            for proc_call in occurrence_calls
-            for stmt in gen_if(proc_call, gen_return(gen_constant(True)))
-        ]
+        occurrence_tries: List[Statement] = []
+        stored = False
+        for proc_call, observes in zip(occurrence_calls, observing):
+            if observes and not stored:
+                occurrence_tries.append(gen_insert_call(symbol_id, arity))
+                stored = True
+            occurrence_tries += gen_if(proc_call, gen_return(gen_constant(True)))
+        if not stored:
+            occurrence_tries.append(gen_insert_call(symbol_id, arity))
 
-        delay_checks = [gen_not(gen_name("delayed"))]
-        if arity > 0:
-            delay_checks.append(gen_or(*(
+    if occurrences:
+        # the constraint is only suspended on variables at positions some occurrence depends on
+        suspended_positions = sorted(set().union(*dependencies))
+        delay_call: List[Statement] = gen_if(
+            gen_or(*(
                 gen_and(
                     gen_call(
                         "isinstance",
@@ -1228,22 +1859,15 @@ def compile_activate_procedure(symbol: str, arity: int, occurrences: List[ast.Fu
                         gen_subscript_index(gen_name("args"), gen_constant(i))
                     ))
                 )
-                for i in range(0, arity)
-            )))
-
-        delay_call: List[Statement] = gen_if(
-            gen_and(*delay_checks),
+                for i in suspended_positions
+            )),
             gen_expr(gen_call(
-                gen_attribute(gen_self(), "builtin", "delay"),
-                gen_lambda(gen_call(
-                    gen_attribute(gen_self(), proc_name),
-                    gen_name("index"),
-                    *args_ast,
-                    delayed=gen_constant(True)
-                )),
-                *args_ast,
+                gen_attribute(gen_self(), "chr", "suspend"),
+                gen_name("index"),
+                gen_attribute(gen_self(), f"__wake_{symbol}_{arity}"),
+                gen_name("args")
             ))
-        )
+        ) if suspended_positions else []
         body = [
             *occurrence_tries,
             *delay_call,
@@ -1252,6 +1876,7 @@ def compile_activate_procedure(symbol: str, arity: int, occurrences: List[ast.Fu
 
     else:
         body = [
+            gen_insert_call(symbol_id, arity),
             gen_return(gen_constant(True))
         ]
 
@@ -1263,8 +1888,8 @@ def compile_activate_procedure(symbol: str, arity: int, occurrences: List[ast.Fu
                 ast.arg(arg="index", annotation=None)
             ],
             vararg=ast.arg(arg="args", annotation=None) if arity > 0 else None,
-            kwonlyargs=[ast.arg(arg="delayed", annotation=None)],
-            kw_defaults=[gen_constant(False)],
+            kwonlyargs=[],
+            kw_defaults=[],
             defaults=[],
             kwarg=None
         ),
@@ -1272,6 +1897,59 @@ def compile_activate_procedure(symbol: str, arity: int, occurrences: List[ast.Fu
     )
 
 
+def compile_wake_procedure(
+        symbol: str,
+        arity: int,
+        occurrences: List[ast.FunctionDef],
+        dependencies: List[Set[int]]
+) -> Optional[Statement]:
+    """
+    Compiles the procedure called for a suspended constraint, when some of its variables
+    are bound (see chr.runtime.BuiltInStore.wake). It only retries the occurrences,
+    that depend on the positions of these variables, given as a bit mask.
+    :return: the procedure, or None, if no occurrence depends on any argument
+    """
+    if not any(dependencies):
+        return None
+
+    occurrence_tries: List[Statement] = [
+        stmt
+        for proc, positions in zip(occurrences, dependencies)
+        if positions
+        for stmt in gen_if(
+            gen_and(
+                ast.BinOp(
+                    left=gen_name("positions"),
+                    op=ast.BitAnd(),
+                    right=gen_constant(position_mask(positions))
+                ),
+                gen_call(
+                    gen_attribute(gen_self(), proc.name),
+                    gen_name("index"),
+                    gen_starred(gen_name("args"))
+                )
+            ),
+            gen_return(gen_constant(True))
+        )
+    ]
+
+    return gen_func_def(
+        f"__wake_{symbol}_{arity}",
+        ast.arguments(
+            args=[
+                ast.arg(arg="self", annotation=None),
+                ast.arg(arg="index", annotation=None),
+                ast.arg(arg="positions", annotation=None)
+            ],
+            vararg=ast.arg(arg="args", annotation=None),
+            defaults=[],
+            kwarg=None
+        ),
+        *occurrence_tries,
+        gen_return(gen_constant(False))
+    )
+
+
 def compile_public_procedure(symbol: str, arities: List[int]) -> Statement:
     if not arities:
         raise CHRCompilationError(f"symbol {symbol} hast no valid arities")
@@ -1289,11 +1967,6 @@ def compile_public_procedure(symbol: str, arities: List[int]) -> Statement:
                 [gen_name("new_id")],
                 gen_call(gen_attribute(gen_self(), "chr", "new"))
             ),
-            gen_assign(
-                [gen_name("new_constraint")],
-                gen_tuple(gen_constant(f"{symbol}/{arity}"), gen_starred(gen_name("args")))
-            ),
-            gen_insert_call("new_constraint", "new_id"),
             gen_return(
                 gen_call(
                     gen_attribute(gen_self(), f"__activate_{symbol}_{arity}"),
@@ -1331,7 +2004,14 @@ def compile_public_procedure(symbol: str, arities: List[int]) -> Statement:
 
 
 def compile_omega_r_program(solver_class_name: str, program: Program) -> ast.Module:
-    known_chr_constraints = set(program.user_constraints)
+    # constraints are tagged with the position of their signature in this dict,
+    # which is emitted as the "symbols" list of the solver class
+    known_chr_constraints: Dict[str, int] = {}
+    for signature in [
+        *program.user_constraints,
+        *(f"{head.symbol}/{head.arity}" for rule in program.rules for head in rule.head)
+    ]:
+        known_chr_constraints.setdefault(signature, len(known_chr_constraints))
 
     occurrences: Dict[Tuple[str, int], List[ast.FunctionDef]] = {
         (symbol, int(arity)): []
@@ -1343,28 +2023,89 @@ def compile_omega_r_program(solver_class_name: str, program: Program) -> ast.Mod
         for symbol, arity in map(lambda x: x.split('/'), known_chr_constraints)
     }
 
-    for rule in program.rules:
-        definitions: List[Tuple[str, int, ast.FunctionDef]] = [
-            compile_occurrence(occurrence_scheme, known_chr_constraints)
+    indexes: Set[Tuple[str, Tuple[int, ...]]] = set()
+
+    keys = functional_dependencies(program)
+
+    dependencies: Dict[Tuple[str, int], List[Set[int]]] = {
+        signature: [] for signature in occurrences
+    }
+
+    tags: Dict[Tuple[str, int], List[Dict[int, tuple]]] = {
+        signature: [] for signature in occurrences
+    }
+
+    observing: Dict[Tuple[str, int], List[bool]] = {
+        signature: [] for signature in occurrences
+    }
+
+    for rule_id, rule in enumerate(program.rules):
+        definitions: List[Tuple[str, int, ast.FunctionDef, Set[int], Dict[int, tuple]]] = [
+            (
+                *compile_occurrence(occurrence_scheme, known_chr_constraints, indexes, rule_id, keys),
+                occurrence_dependencies(occurrence_scheme),
+                occurrence_tags(occurrence_scheme),
+                occurrence_observes(occurrence_scheme)
+            )
             for occurrence_scheme in rule.get_occurrence_schemes()
         ]
 
-        for symbol, arity, func_ast in definitions:
+        for symbol, arity, func_ast, positions, occurrence_tag, observes in definitions:
             if (symbol, arity) in occurrences:
                 occurrences[symbol, arity].append(func_ast)
+                dependencies[symbol, arity].append(positions)
+                tags[symbol, arity].append(occurrence_tag)
+                observing[symbol, arity].append(observes)
             else:
                 occurrences[symbol, arity] = [func_ast]
+                dependencies[symbol, arity] = [positions]
+                tags[symbol, arity] = [occurrence_tag]
+                observing[symbol, arity] = [observes]
 
             if symbol in constraints:
                 constraints[symbol].add(arity)
             else:
                 constraints[symbol] = {arity}
 
+    dispatch_positions = {
+        signature: dispatch_position(tags[signature]) for signature in occurrences
+    }
+
     activation_procedures = [
-        compile_activate_procedure(symbol, arity, occurrences[symbol, arity])
+        compile_activate_procedure(
+            symbol,
+            arity,
+            procedures,
+            dependencies[symbol, arity],
+            observing[symbol, arity],
+            known_chr_constraints[f"{symbol}/{arity}"],
+            dispatch_positions[symbol, arity]
+        )
         for (symbol, arity), procedures in occurrences.items()
     ]
 
+    dispatch_tables = [
+        stmt
+        for (symbol, arity), procedures in occurrences.items()
+        if dispatch_positions[symbol, arity] is not None
+        for stmt in compile_dispatch_table(
+            symbol,
+            arity,
+            procedures,
+            tags[symbol, arity],
+            dispatch_positions[symbol, arity],
+            observing[symbol, arity],
+            known_chr_constraints[f"{symbol}/{arity}"]
+        )
+    ]
+
+    wake_procedures = [
+        proc
+        for (symbol, arity), procedures in occurrences.items()
+        for proc in [compile_wake_procedure(symbol, arity, procedures, dependencies[symbol, arity])]
+        if proc is not None
+    ]
+
     constraint_procedures = [
         proc
         for procs in occurrences.values()
@@ -1376,6 +2117,38 @@ def compile_omega_r_program(solver_class_name: str, program: Program) -> ast.Mod
         for symbol, arities in constraints.items()
     ]
 
+    rule_names = gen_assign(
+        [gen_name("rule_names")],
+        gen_list(*(gen_constant(rule.name) for rule in program.rules))
+    )
+
+    symbols = gen_assign(
+        [gen_name("symbols")],
+        gen_list(*(gen_constant(signature) for signature in known_chr_constraints))
+    )
+
+    index_declarations = [
+        gen_assign(
+            [gen_name("indexes")],
+            gen_list(*(
+                gen_tuple(gen_constant(symbol), gen_tuple(*(gen_constant(i) for i in positions)))
+                for symbol, positions in sorted(indexes)
+            ))
+        )
+    ] if indexes else []
+
+    unknown_columnar = set(program.columnar) - set(program.user_constraints)
+    if unknown_columnar:
+        raise CHRCompilationError(f"Columnar constraints {unknown_columnar} not declared.")
+
+    columnar = set(program.columnar)
+    columnar_declarations = [
+        gen_assign(
+            [gen_name("columnar")],
+            gen_list(*(gen_constant(signature) for signature in sorted(columnar)))
+        )
+    ] if columnar else []
+
     return ast.Module(body=[
         ast.ImportFrom(
             module="chr.runtime",
@@ -1387,6 +2160,8 @@ def compile_omega_r_program(solver_class_name: str, program: Program) -> ast.Mod
                 ast.alias(name="CHRGuardFail", asname=None),
                 ast.alias(name="get_value", asname=None),
                 ast.alias(name="is_bound", asname=None),
+                ast.alias(name="equal", asname=None),
+                ast.alias(name="dispatch_key", asname=None),
                 ast.alias(name="unify", asname=None)
             ],
             level=0
@@ -1394,8 +2169,14 @@ def compile_omega_r_program(solver_class_name: str, program: Program) -> ast.Mod
         ast.ClassDef(
             name=solver_class_name,
             body=[
+                rule_names,
+                symbols,
+                *index_declarations,
+                *columnar_declarations,
                 *constraint_procedures,
+                *dispatch_tables,
                 *activation_procedures,
+                *wake_procedures,
                 *public_procedures
             ],
             bases=[ast.Name("CHRSolver")],
@@ -1405,11 +2186,12 @@ def compile_omega_r_program(solver_class_name: str, program: Program) -> ast.Mod
     ])
 
 
-def chr_compile_source(source: str, verbose: bool = False) -> str:
+def chr_compile_source(source: str, verbose: bool = False, join_plan: bool = False) -> str:
     """
     Compiles CHR source code into python source code
     :param source: CHR program as a string
     :param verbose: Gives some extra output if set to True.
+    :param join_plan: Prints the join order chosen for each occurrence if set to True.
     :return: Generated Python code
     """
     if verbose:
@@ -1417,6 +2199,11 @@ def chr_compile_source(source: str, verbose: bool = False) -> str:
     chr_ast = chr_parse(source).get_normal_form().omega_r()
     if verbose:
         print("done.")
+    if join_plan:
+        for rule in chr_ast.rules:
+            for occurrence_scheme in rule.get_occurrence_schemes():
+                print(format_join_plan(occurrence_scheme))
+    if verbose:
         print("Compiling to python ast...", end=" ")
     python_ast = compile_omega_r_program(chr_ast.class_name, chr_ast)
     if verbose:
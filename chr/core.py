@@ -11,7 +11,8 @@ def chr_compile(
         input_file_path: str,
         output_file_path: str,
         overwrite: Union[bool, str] = False,
-        verbose: bool = False
+        verbose: bool = False,
+        join_plan: bool = False
 ):
     """
     Reads and compiles a CHR source file, and writes the generated code it
@@ -23,6 +24,7 @@ def chr_compile(
         if set to "timestamp", an existing output file is overwritten,
         if it was last modified before the source file (i.e. if it is outdated)
     :param verbose: If set to True, some additional information is given
+    :param join_plan: If set to True, the join order chosen for each occurrence is printed
     :return: True, if output was written; False otherwise
     """
 
@@ -44,7 +46,7 @@ def chr_compile(
 
     with open(input_file_path, "r") as input_file:
         chr_source = input_file.read()
-        python_source = chr_compile_source(chr_source, verbose=verbose)
+        python_source = chr_compile_source(chr_source, verbose=verbose, join_plan=join_plan)
         with open(output_file_path, "w") as output_file:
             output_file.write(python_source)
 
@@ -347,6 +347,55 @@ def parse_declaration():
     return cs
 
 
+@generate
+def parse_key():
+    signature = yield lit_white >> lit_signature
+    yield lit_white >> string('(')
+    position = yield lit_white >> regex(r'[0-9]+').map(int)
+    positions = [position]
+    while True:
+        sep = yield lit_white >> (string(',') | string(')'))
+        if sep == ')':
+            break
+
+        position = yield lit_white >> regex(r'[0-9]+').map(int)
+        positions.append(position)
+
+    return signature, tuple(positions)
+
+
+@generate
+def parse_keys_declaration():
+    yield lit_white >> string("keys")
+    k = yield lit_white >> parse_key
+    ks = [k]
+    while True:
+        comma = yield lit_white >> (string(',') | string('.'))
+        if comma == '.':
+            break
+
+        k1 = yield lit_white >> parse_key
+        ks.append(k1)
+
+    return ks
+
+
+@generate
+def parse_columnar_declaration():
+    yield lit_white >> string("columnar")
+    c = yield lit_white >> parse_signature
+    cs = [c]
+    while True:
+        comma = yield lit_white >> (string(',') | string('.'))
+        if comma == '.':
+            break
+
+        c1 = yield lit_white >> parse_signature
+        cs.append(c1)
+
+    return cs
+
+
 @generate
 def parse_class_name():
     yield lit_white >> string("class")
@@ -367,8 +416,10 @@ def parse_program():
     def fun():
         class_name = yield parse_class_name
         decls = yield parse_declaration
+        keys = yield parse_keys_declaration.optional()
+        columnar = yield parse_columnar_declaration.optional()
         rules = yield parse_rules(rule_name_gen)
-        return Program(class_name, decls, rules)
+        return Program(class_name, decls, rules, keys, columnar)
 
     return fun
 
@@ -1,4 +1,16 @@
-from typing import Any, Optional, Callable
+from array import array
+from bisect import bisect_left
+from copy import copy
+from heapq import merge
+from itertools import compress, repeat
+from operator import itemgetter, lt, le, eq, ne, ge, gt, mul
+import sys
+from typing import Any, Optional, Callable, Iterable, Tuple, List
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class UndefinedConstraintError(Exception):
@@ -22,123 +34,1160 @@ class CHRGuardFail(Exception):
         self.messages = messages
 
 
-class CHRStore:
+class ConstraintBucket:
+    """
+    Container of (id, constraint) pairs, that can be iterated while constraints are
+    inserted and deleted, without taking a snapshot.
+
+    Ids and constraints are kept in two parallel lists sorted by id. Deleted constraints
+    are only replaced by None, and dropped when the lists are compacted; compaction creates
+    new lists, and running iterations find their position again by id.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.records = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, index):
+        return self.find(index) >= 0
+
+    def find(self, index):
+        """
+        :return: the position of the live constraint with the given id, or -1
+        """
+        ids = self.ids
+        position = bisect_left(ids, index)
+        if position < len(ids) and ids[position] == index and self.records[position] is not None:
+            return position
+        return -1
+
+    def add(self, index, constraint):
+        ids = self.ids
+        if not ids or ids[-1] < index:
+            ids.append(index)
+            self.records.append(constraint)
+        else:
+            # re-insertion of a deleted constraint on backtracking
+            position = bisect_left(ids, index)
+            if position < len(ids) and ids[position] == index:
+                self.records[position] = constraint
+            else:
+                ids.insert(position, index)
+                self.records.insert(position, constraint)
+        self.count += 1
+
+    def remove(self, index):
+        position = self.find(index)
+        if position < 0:
+            raise KeyError(index)
+
+        self.records[position] = None
+        self.count -= 1
+        if len(self.ids) > 2 * self.count + 8:
+            self.compact()
+
+    def compact(self):
+        ids = self.ids
+        rows = [position for position, record in enumerate(self.records) if record is not None]
+        self.ids = [ids[position] for position in rows]
+        self.records = [self.records[position] for position in rows]
+
+    def iterate(self, limit):
+        """
+        Iterates over the (id, constraint) pairs in the bucket, with ids lower than limit.
+        Constraints deleted during the iteration are skipped.
+        :param limit: first id not to visit, i.e. the next id at the start of the iteration
+        """
+        position = 0
+        while True:
+            ids, records = self.ids, self.records
+            # ids appended during the iteration are not lower than limit
+            end = bisect_left(ids, limit)
+            while position < end:
+                record = records[position]
+                if record is not None:
+                    index = ids[position]
+                    yield index, record
+                    if self.ids is not ids:
+                        # the lists were compacted during the iteration
+                        position = bisect_left(self.ids, index + 1)
+                        break
+                position += 1
+            else:
+                return
+
+
+COLUMN_MIN = -2 ** 63
+COLUMN_MAX = 2 ** 63 - 1
+
+# comparisons for selecting rows by the value of an argument (see ColumnarBucket.select)
+COLUMN_COMPARISONS = {"<": lt, "<=": le, "==": eq, "!=": ne, ">=": ge, ">": gt}
+
+
+class ColumnarBucket:
+    """
+    Container of (id, constraint) pairs of one signature, like ConstraintBucket, that keeps
+    constraints with int arguments in typed columns: one for the ids, one per argument,
+    and an alive mask. Constraints with other arguments (e.g. logic variables) are kept
+    in an overflow ConstraintBucket.
+
+    Rows are sorted by id. Deleted rows are only marked in the alive mask, and dropped when
+    the columns are compacted; running iterations find their position again by id.
+    """
+
+    def __init__(self, symbol: str, arity: int):
+        self.symbol = symbol
+        self.ids = array('q')
+        self.columns = [array('q') for _ in range(arity)]
+        self.alive = bytearray()
+        self.count = 0
+        self.overflow = ConstraintBucket()
+
+    def __len__(self):
+        return self.count + len(self.overflow)
+
+    def __contains__(self, index):
+        return self.find(index) >= 0 or index in self.overflow
+
+    def find(self, index):
+        """
+        :return: the row of the live constraint with the given id, or -1
+        """
+        ids = self.ids
+        position = bisect_left(ids, index)
+        if position < len(ids) and ids[position] == index and self.alive[position]:
+            return position
+        return -1
+
+    def row(self, position):
+        return (self.symbol, *(column[position] for column in self.columns))
+
+    def get(self, index):
+        return self.row(self.find(index))
+
+    def add(self, index, constraint):
+        values = constraint[1:]
+        if not all(type(value) is int and COLUMN_MIN <= value <= COLUMN_MAX for value in values):
+            self.overflow.add(index, constraint)
+            return False
+
+        ids = self.ids
+        if not ids or ids[-1] < index:
+            ids.append(index)
+            for column, value in zip(self.columns, values):
+                column.append(value)
+            self.alive.append(1)
+        else:
+            # re-insertion of a deleted constraint on backtracking
+            position = bisect_left(ids, index)
+            if position < len(ids) and ids[position] == index:
+                for column, value in zip(self.columns, values):
+                    column[position] = value
+                self.alive[position] = 1
+            else:
+                ids.insert(position, index)
+                for column, value in zip(self.columns, values):
+                    column.insert(position, value)
+                self.alive.insert(position, 1)
+        self.count += 1
+        return True
+
+    def remove(self, index):
+        position = self.find(index)
+        if position < 0:
+            self.overflow.remove(index)
+            return
+
+        self.alive[position] = 0
+        self.count -= 1
+        if len(self.ids) > 2 * self.count + 8:
+            self.compact()
+
+    def compact(self):
+        alive = self.alive
+        rows = [position for position in range(len(alive)) if alive[position]]
+        self.ids = array('q', (self.ids[position] for position in rows))
+        self.columns = [array('q', (column[position] for position in rows)) for column in self.columns]
+        self.alive = bytearray(b'\x01' * len(rows))
+
+    def iterate_rows(self, limit):
+        symbol = self.symbol
+        position = 0
+        while True:
+            ids, alive, columns = self.ids, self.alive, self.columns
+            end = bisect_left(ids, limit)
+            while position < end:
+                if alive[position]:
+                    index = ids[position]
+                    if len(columns) == 1:
+                        yield index, (symbol, columns[0][position])
+                    else:
+                        yield index, (symbol, *[column[position] for column in columns])
+                    if self.ids is not ids:
+                        # the columns were compacted during the iteration
+                        position = bisect_left(self.ids, index + 1)
+                        break
+                position += 1
+            else:
+                return
+
+    def iterate(self, limit):
+        """
+        Iterates over the (id, constraint) pairs in the bucket, with ids lower than limit.
+        Constraints deleted during the iteration are skipped.
+        :param limit: first id not to visit, i.e. the next id at the start of the iteration
+        """
+        if not self.overflow:
+            return self.iterate_rows(limit)
+        return merge(self.iterate_rows(limit), self.overflow.iterate(limit), key=itemgetter(0))
+
+    def export(self):
+        """
+        Exports the live rows, i.e. all constraints with int arguments.
+        :return: tuple of the ids and the argument columns, as NumPy arrays if NumPy
+            is installed, as arrays of the array module otherwise
+        """
+        if numpy is None or not self.alive:
+            return (
+                array('q', compress(self.ids, self.alive)),
+                [array('q', compress(column, self.alive)) for column in self.columns]
+            )
+
+        mask = numpy.frombuffer(self.alive, dtype=numpy.uint8).astype(bool)
+        return (
+            numpy.frombuffer(self.ids, dtype=numpy.int64)[mask],
+            [numpy.frombuffer(column, dtype=numpy.int64)[mask] for column in self.columns]
+        )
+
+    def select(self, position: int, comparison: str, value: int):
+        """
+        Exports the live rows, whose argument at the given position compares to value,
+        e.g. select(0, ">", 10) for the constraints with a first argument greater than 10.
+        With NumPy, the comparison is done on the whole column at once.
+        :param position: argument position (starting at 0)
+        :param comparison: one of <, <=, ==, !=, >=, >
+        :param value: number to compare with
+        :return: tuple of the ids and the argument columns of the selected rows (see export)
+        """
+        compare = COLUMN_COMPARISONS[comparison]
+        if numpy is not None and self.alive:
+            ids, columns = self.export()
+            mask = compare(columns[position], value)
+            return ids[mask], [column[mask] for column in columns]
+
+        # one flag per row, alive and selected
+        selected = bytes(map(mul, self.alive, map(compare, self.columns[position], repeat(value))))
+        return (
+            array('q', compress(self.ids, selected)),
+            [array('q', compress(column, selected)) for column in self.columns]
+        )
+
+
+def iterate_buckets(limit, *buckets):
+    """
+    Iterates over the (id, constraint) pairs of several disjoint buckets, ordered by id.
+    """
+    buckets = [bucket for bucket in buckets if bucket]
+    if not buckets:
+        return ()
+    if len(buckets) == 1:
+        return buckets[0].iterate(limit)
+    return merge(*(bucket.iterate(limit) for bucket in buckets), key=itemgetter(0))
+
+
+class HashIndex:
+    """
+    Hash index on the arguments at some positions of the constraints of one signature.
+
+    Constraints are kept in one of three parts:
+        - ground: constraints with hashable values at all indexed positions, by key
+        - variables: constraints with logic variables at some indexed positions,
+          by position and variable index; lookups with an unbound variable collect
+          the entries of all variables in its union-find class
+        - unindexed: constraints with other unhashable values at indexed positions
+    """
+
+    def __init__(self, positions: Tuple[int, ...]):
+        self.positions = positions
+        self.ground = {}
+        self.variables = [{} for _ in positions]
+        self.variable_entries = ConstraintBucket()
+        self.unindexed = ConstraintBucket()
+
+    def add(self, constraint, index):
+        values = tuple(constraint[position + 1] for position in self.positions)
+        try:
+            if values not in self.ground:
+                self.ground[values] = ConstraintBucket()
+            self.ground[values].add(index, constraint)
+            return
+        except TypeError:
+            pass
+
+        variable_positions = [i for i, value in enumerate(values) if isinstance(value, LogicVariable)]
+        if not variable_positions:
+            self.unindexed.add(index, constraint)
+            return
+
+        for i in variable_positions:
+            table = self.variables[i]
+            if values[i].index not in table:
+                table[values[i].index] = ConstraintBucket()
+            table[values[i].index].add(index, constraint)
+        self.variable_entries.add(index, constraint)
+
+    def remove(self, constraint, index):
+        if index in self.unindexed:
+            self.unindexed.remove(index)
+            return
+
+        values = tuple(constraint[position + 1] for position in self.positions)
+        if index in self.variable_entries:
+            self.variable_entries.remove(index)
+            for i, value in enumerate(values):
+                if isinstance(value, LogicVariable):
+                    table = self.variables[i]
+                    table[value.index].remove(index)
+                    if not table[value.index]:
+                        del table[value.index]
+            return
+
+        self.ground[values].remove(index)
+        if not self.ground[values]:
+            del self.ground[values]
+
+    def lookup(self, key, bucket, limit):
+        """
+        Looks up the candidates for constraints, whose arguments at the indexed positions
+        are equal to key.
+        The result may contain more constraints than actually match (e.g. constraints with
+        variables bound after their insertion), but never misses a matching one.
+        :param key: tuple of values for the indexed positions
+        :param bucket: all constraints of the indexed signature, visited if key is unhashable
+        :param limit: first id not to visit (see ConstraintBucket.iterate)
+        :return: iterable of (id, constraint) pairs
+        """
+        key = tuple(get_value(value) for value in key)
+
+        for i, value in enumerate(key):
+            if isinstance(value, LogicVariable):
+                # an unbound variable only equals the variables of its own class
+                table = self.variables[i]
+                return iterate_buckets(
+                    limit,
+                    self.unindexed,
+                    *(table[member] for member in value.store.get_class_members(value.index) if member in table)
+                )
+
+        try:
+            ground = self.ground[key] if key in self.ground else None
+        except TypeError:
+            return iterate_buckets(limit, bucket)
+
+        return iterate_buckets(limit, ground, self.unindexed, self.variable_entries)
+
+    def find(self, key, bucket, limit, exclude=()):
+        """
+        Finds the first constraint, whose arguments at the indexed positions are equal to key.
+        If all constraints have hashable values at the indexed positions, and so does key,
+        this is a single dictionary lookup.
+        :param key: tuple of values for the indexed positions
+        :param bucket: all constraints of the indexed signature (see lookup)
+        :param limit: first id not to visit (see lookup)
+        :param exclude: ids of constraints to skip
+        :return: the (id, constraint) pair, or (None, None)
+        """
+        key = tuple(get_value(value) for value in key)
+
+        if not self.variable_entries and not self.unindexed:
+            try:
+                ground = self.ground.get(key)
+            except TypeError:
+                pass
+            else:
+                if ground is not None:
+                    for constraint_id, constraint in zip(ground.ids, ground.records):
+                        if constraint is not None and constraint_id not in exclude:
+                            return constraint_id, constraint
+                return None, None
+
+        for constraint_id, constraint in self.lookup(key, bucket, limit):
+            if constraint_id in exclude:
+                continue
+            if all(equal(constraint[p + 1], k) for p, k in zip(self.positions, key)):
+                return constraint_id, constraint
+        return None, None
+
+
+class InternTable:
+    """
+    Hash-consing of ground terms: equal ground terms are replaced by one shared instance.
+    Strings are interned, and tuples, lists and dicts of ground terms are shared through
+    a table; so shared lists and dicts must not be mutated.
+    Terms with logic variables are not ground, so only their ground sub-terms are shared.
+    """
 
     def __init__(self):
+        # shared terms by type and keys of their elements (see share)
+        self.terms = {}
+
+    def __len__(self):
+        return len(self.terms)
+
+    def clear(self):
+        self.terms = {}
+
+    @staticmethod
+    def elements(term) -> tuple:
+        if type(term) is dict:
+            return (*term.keys(), *term.values())
+        return tuple(term)
+
+    def intern(self, term):
+        """
+        :param term: term to intern
+        :return: an equal term, whose ground sub-terms are shared with previously interned terms
+        """
+        return self.share(term)[0]
+
+    def share(self, term) -> Tuple[Any, Any]:
+        """
+        Containers are walked with an explicit stack, so arbitrarily deep terms can be interned.
+        :param term: term to intern
+        :return: the interned term, and its key in the table; None, if the term is not ground.
+            Shared containers are keyed by their identity.
+        """
+        term_type = type(term)
+        if term_type is not tuple and term_type is not list and term_type is not dict:
+            return self.share_atom(term)
+
+        # (container, its elements, number of them that are containers, whether these were
+        # pushed); the (interned term, key) pairs of the latter are on top of results,
+        # when the container is popped again
+        stack = [(term, self.elements(term), 0, False)]
+        results = []
+        while stack:
+            term, originals, containers, entered = stack.pop()
+            if not entered:
+                children = [
+                    element for element in originals
+                    if type(element) is tuple or type(element) is list or type(element) is dict
+                ]
+                if children:
+                    stack.append((term, originals, len(children), True))
+                    stack.extend((child, self.elements(child), 0, False) for child in reversed(children))
+                    continue
+
+            if containers:
+                start = len(results) - containers
+                shared_children = iter(results[start:])
+                del results[start:]
+            elements = []
+            keys = []
+            for original in originals:
+                original_type = type(original)
+                if original_type is str:
+                    element = key = sys.intern(original)
+                elif original_type is float or original_type is complex:
+                    # equal numbers may differ, e.g. 0.0 == -0.0
+                    element, key = original, (original_type, repr(original))
+                elif original_type in ATOMIC_TYPES:
+                    element = key = original
+                elif original_type is tuple or original_type is list or original_type is dict:
+                    element, key = next(shared_children)
+                else:
+                    element, key = original, None
+                elements.append(element)
+                keys.append(key)
+            results.append(self.share_container(term, originals, elements, keys))
+
+        return results[0]
+
+    @staticmethod
+    def share_atom(term) -> Tuple[Any, Any]:
+        term_type = type(term)
+        if term_type is str:
+            term = sys.intern(term)
+            return term, term
+        if term_type is float or term_type is complex:
+            return term, (term_type, repr(term))
+        if term_type in ATOMIC_TYPES:
+            return term, term
+        return term, None
+
+    def share_container(self, term, originals, elements, keys) -> Tuple[Any, Any]:
+        """
+        Shares a container, given its interned elements and their keys (see share).
+        """
+        term_type = type(term)
+        if all(element is original for element, original in zip(elements, originals)):
+            interned = term
+        elif term_type is dict:
+            interned = dict(zip(elements[:len(term)], elements[len(term):]))
+        else:
+            interned = term_type(elements)
+
+        if any(key is None for key in keys):
+            return interned, None
+
+        key = term_type, tuple(keys)
+        shared = self.terms.setdefault(key, interned)
+        # equal keys are not enough, e.g. (1,) == (True,) == (1.0,)
+        if shared is not interned and not all(
+                a is b or type(a) is type(b)
+                for a, b in zip(self.elements(shared), elements)
+        ):
+            return interned, None
+        return shared, (SHARED, id(shared))
+
+
+SHARED = object()
+
+
+HISTORY_COLLECTION_SIZE = 1024
+ALIVE_WINDOW_SIZE = 1024
+RECLAIM_BATCH_SIZE = 1024
+INTERN_TABLE_SIZE = 1024
+
+
+class CHRStore:
+
+    def __init__(
+            self,
+            indexes: Iterable[Tuple[str, Tuple[int, ...]]] = (),
+            trail: bool = True,
+            columnar: Iterable[str] = (),
+            builtin: Optional['BuiltInStore'] = None,
+            intern: bool = False,
+            symbols: Iterable[str] = ()
+    ):
+        """
+        :param indexes: hash indexes to declare (see add_index)
+        :param trail: if set to False, no undo information is recorded, and the store
+            cannot backtrack; set_save_point and drop_save_point do nothing
+        :param columnar: signatures (e.g. "gcd/1") of constraints to keep in typed columns,
+            if their arguments are ints (see ColumnarBucket and export)
+        :param builtin: builtin store, that keeps the suspensions of the constraints (see suspend)
+        :param intern: if set to True, equal ground terms in inserted constraints are
+            shared (see InternTable)
+        :param symbols: signatures of the constraints, whose first element is the position
+            of their signature in this list instead of the signature itself; indexes and
+            columnar may name them by signature, and dump restores the signatures
+        """
         self.next_id = 0
-        self.alive_set = {}
+        # liveness of the ids from alive_base to next_id, one byte per id;
+        # alive_count counts the live ids among them; live ids below alive_base
+        # are kept in alive_below_base (see compact_alive)
+        self.alive_flags = bytearray()
+        self.alive_base = 0
+        self.alive_count = 0
+        self.alive_below_base = set()
+        # constraints by id; constraints kept in the columns of a ColumnarBucket
+        # are represented by the bucket (see get_constraint)
         self.constraints = {}
-        self.history = set()
+        self.symbols = list(symbols)
+        self.symbol_ids = {signature: i for i, signature in enumerate(self.symbols)}
+        self.buckets = {}
+        self.indexes = {}
+        self.columnar = False
+        # propagation history by rule id; entries are tuples of constraint ids,
+        # or single ids for rules with one head constraint
+        self.history = {}
+        self.history_entries = 0
+        self.next_history_collection = HISTORY_COLLECTION_SIZE
+        self.trailing = trail
         self.trail = [[]]
+        self.builtin = builtin
+        # version of the solver state the store represents, if the solver was forked
+        self.version = None
+        # shared ground terms; the table is rebuilt from the live constraints,
+        # whenever it has doubled its size (see rebuild_intern_table)
+        self.intern_table = InternTable() if intern else None
+        self.next_intern_table_rebuild = INTERN_TABLE_SIZE
+
+        for signature in columnar:
+            symbol = self.symbol_ids.get(signature, signature)
+            self.buckets[symbol] = ColumnarBucket(symbol, int(signature.rsplit('/', 1)[1]))
+            self.columnar = True
+
+        for symbol, positions in indexes:
+            self.add_index(symbol, positions)
 
     def new(self):
         index = self.next_id
         self.next_id += 1
-        self.alive_set[index] = True
+        self.alive_flags.append(1)
+        self.alive_count += 1
         return index
 
     def set_save_point(self):
-        self.trail.append([])
+        if self.trailing:
+            self.trail.append([])
 
     def drop_save_point(self):
-        self.trail.pop()
+        if self.trailing:
+            save_point = self.trail.pop()
+            # the changes stay undoable by the enclosing save point
+            if self.trail:
+                self.trail[-1] += save_point
 
     def backtrack(self):
+        if not self.trailing:
+            raise Exception('cannot backtrack without trail')
         save_point = self.trail.pop()
         while save_point:
-            action, value = save_point.pop()
-            if action == "add_to_history":
-                self.history.remove(value)
-            elif action == "constraint_insert":
-                del self.constraints[value]
-                del self.alive_set[value]
-            elif action == "constraint_delete":
-                self.constraints[value[0]] = value[1]
-                self.alive_set[value[0]] = True
-
-    def add_to_history(self, rule_name, *ids):
-        history_entry = rule_name, ids
-        self.history.add(history_entry)
-        self.trail[-1].append(("add_to_history", history_entry))
-
-    def in_history(self, rule_name, *ids):
-        return (rule_name, ids) in self.history
+            self.undo(*save_point.pop())
 
-    def alive(self, id):
-        if id in self.alive_set:
-            return self.alive_set[id]
+    def undo(self, action, value):
+        """
+        Reverts one change recorded on the trail.
+        """
+        if action == "add_to_history":
+            self.history[value[0]].remove(value[1])
+            self.history_entries -= 1
+        elif action == "collect_history":
+            for rule, entries in value:
+                self.history[rule].update(entries)
+                self.history_entries += len(entries)
+        elif action == "constraint_insert":
+            self.remove_from_buckets(value[1], value[0])
+            del self.constraints[value[0]]
+            self.mark_dead(value[0])
+        elif action == "constraint_delete":
+            self.constraints[value[0]] = self.add_to_buckets(value[1], value[0])
+            self.mark_alive(value[0])
+            if value[2] is not None:
+                self.builtin.delay(value[0], *value[2])
+        elif action == "suspend":
+            self.builtin.kill(value[0])
+
+    def redo(self, action, value):
+        """
+        Repeats one change recorded on the trail, after it was reverted by undo.
+        """
+        if action == "add_to_history":
+            self.history.setdefault(value[0], set()).add(value[1])
+            self.history_entries += 1
+        elif action == "collect_history":
+            for rule, entries in value:
+                self.history[rule].difference_update(entries)
+                self.history_entries -= len(entries)
+        elif action == "constraint_insert":
+            self.constraints[value[0]] = self.add_to_buckets(value[1], value[0])
+            self.mark_alive(value[0])
+        elif action == "constraint_delete":
+            self.remove_from_buckets(value[1], value[0])
+            del self.constraints[value[0]]
+            self.mark_dead(value[0])
+            if value[2] is not None:
+                self.builtin.kill(value[0])
+        elif action == "suspend":
+            self.builtin.delay(*value)
+
+    def add_to_history(self, rule, ids):
+        """
+        Adds an entry to the propagation history, if it is not already there.
+        :param rule: id of the rule
+        :param ids: tuple of the ids of the constraints matching the rule head,
+            or a single id for rules with one head constraint
+        :return: True, if the entry was added; False, if it was already in the history
+        """
+        if rule in self.history:
+            entries = self.history[rule]
+            if ids in entries:
+                return False
         else:
-            raise Exception(f'id {id} unknown')
+            entries = self.history[rule] = set()
+
+        entries.add(ids)
+        self.history_entries += 1
+        if self.trailing:
+            self.trail[-1].append(("add_to_history", (rule, ids)))
+
+        if self.history_entries >= self.next_history_collection:
+            self.collect_history()
+
+        return True
+
+    def in_history(self, rule, ids):
+        return rule in self.history and ids in self.history[rule]
+
+    def collect_history(self):
+        """
+        Removes all history entries referring to deleted constraints.
+        As ids are never reused, these entries cannot be looked up again, unless the
+        constraints are restored by backtracking; for this case, the entries are recorded
+        on the trail.
+        The collection runs automatically, whenever the history has doubled its size
+        since the last collection.
+        """
+        constraints = self.constraints
+        collected = []
+        for rule, entries in self.history.items():
+            dead = [
+                ids for ids in entries
+                if not (ids in constraints if type(ids) is int else all(i in constraints for i in ids))
+            ]
+            if dead:
+                entries.difference_update(dead)
+                self.history_entries -= len(dead)
+                collected.append((rule, dead))
+
+        if collected and self.trailing:
+            self.trail[-1].append(("collect_history", collected))
+        self.next_history_collection = max(HISTORY_COLLECTION_SIZE, 2 * self.history_entries)
+
+    def history_size(self):
+        return self.history_entries
+
+    def alive(self, id):
+        offset = id - self.alive_base
+        if offset < 0:
+            return id in self.alive_below_base
+        try:
+            return self.alive_flags[offset] == 1
+        except IndexError:
+            raise Exception(f'id {id} unknown') from None
+
+    def mark_alive(self, index):
+        offset = index - self.alive_base
+        if offset < 0:
+            self.alive_below_base.add(index)
+        elif not self.alive_flags[offset]:
+            self.alive_flags[offset] = 1
+            self.alive_count += 1
+
+    def mark_dead(self, index):
+        offset = index - self.alive_base
+        if offset < 0:
+            self.alive_below_base.discard(index)
+        elif self.alive_flags[offset]:
+            self.alive_flags[offset] = 0
+            self.alive_count -= 1
+            if len(self.alive_flags) > 2 * self.alive_count + ALIVE_WINDOW_SIZE:
+                self.compact_alive()
+
+    def compact_alive(self):
+        """
+        Shrinks the liveness flags to the most recent ids, so their size stays proportional
+        to the number of live constraints, however many constraints were created before.
+        The few live ids before the new base are moved to alive_below_base; all other ids
+        before it are dead.
+        Ids are not reused: running iterations, history entries, the trail and suspended
+        activations may still refer to dead ids, which have to stay dead.
+        """
+        flags = self.alive_flags
+        cut = len(flags) - self.alive_count - ALIVE_WINDOW_SIZE
+        if cut <= 0:
+            return
+        base = self.alive_base
+        position = flags.find(1, 0, cut)
+        while position != -1:
+            self.alive_below_base.add(base + position)
+            self.alive_count -= 1
+            position = flags.find(1, position + 1, cut)
+        del flags[:cut]
+        self.alive_base = base + cut
+
+    def get_constraint(self, index):
+        constraint = self.constraints[index]
+        if type(constraint) is ColumnarBucket:
+            return constraint.get(index)
+        return constraint
 
     def insert(self, constraint, index):
         if index in self.constraints:
             raise Exception(
-                f'constraint with id {index} already set to {self.constraints[index]}'
+                f'constraint with id {index} already set to {self.get_constraint(index)}'
             )
         else:
-            self.constraints[index] = constraint
-            self.trail[-1].append(("constraint_insert", index))
+            if self.intern_table is not None:
+                intern = self.intern_table.intern
+                constraint = (constraint[0], *(intern(arg) for arg in constraint[1:]))
+                if len(self.intern_table) >= self.next_intern_table_rebuild:
+                    self.rebuild_intern_table()
+            self.constraints[index] = self.add_to_buckets(constraint, index)
+            if self.trailing:
+                self.trail[-1].append(("constraint_insert", (index, constraint)))
+
+    def rebuild_intern_table(self):
+        """
+        Drops the terms of deleted constraints from the intern table, by interning the
+        arguments of the live constraints into a new one. They already are shared, so the
+        terms stay the same.
+        """
+        self.intern_table.clear()
+        for constraint in self.constraints.values():
+            if type(constraint) is tuple:
+                for arg in constraint[1:]:
+                    self.intern_table.intern(arg)
+        self.next_intern_table_rebuild = max(INTERN_TABLE_SIZE, 2 * len(self.intern_table))
+
+    def add_index(self, symbol: str, positions: Tuple[int, ...]):
+        """
+        Declares a hash index on the arguments at the given positions of all constraints
+        with the given signature. The index is built from the current store content,
+        and maintained by insert, delete and backtrack afterwards.
+        :param symbol: signature of the indexed constraints, e.g. "node/3"
+        :param positions: argument positions (starting at 0) the index is keyed on
+        """
+        positions = tuple(positions)
+        symbol = self.symbol_ids.get(symbol, symbol)
+        if symbol not in self.indexes:
+            self.indexes[symbol] = {}
+        if positions in self.indexes[symbol]:
+            return
+
+        hash_index = HashIndex(positions)
+        for index, constraint in self.get_iterator(symbol=symbol, fix=True):
+            hash_index.add(constraint, index)
+        self.indexes[symbol][positions] = hash_index
+
+    def add_to_buckets(self, constraint, index):
+        """
+        :return: the constraint, or its ColumnarBucket, if it is kept in typed columns
+        """
+        symbol = constraint[0]
+        if symbol not in self.buckets:
+            self.buckets[symbol] = ConstraintBucket()
+        bucket = self.buckets[symbol]
+        stored = bucket if bucket.add(index, constraint) else constraint
+
+        if symbol in self.indexes:
+            for hash_index in self.indexes[symbol].values():
+                hash_index.add(constraint, index)
+
+        return stored
+
+    def remove_from_buckets(self, constraint, index):
+        symbol = constraint[0]
+        self.buckets[symbol].remove(index)
+
+        if symbol in self.indexes:
+            for hash_index in self.indexes[symbol].values():
+                hash_index.remove(constraint, index)
+
+    def suspend(self, index, activation: Callable, args: tuple):
+        """
+        Suspends a constraint on the unbound variables among its arguments, until it is
+        deleted (see BuiltInStore.delay).
+        :param index: id of the constraint
+        :param activation: wake procedure of the constraint (see BuiltInStore.delay)
+        :param args: arguments of the constraint
+        """
+        self.builtin.delay(index, activation, args)
+        if self.trailing:
+            self.trail[-1].append(("suspend", (index, activation, args)))
 
     def delete(self, index):
+        """
+        Deletes a constraint. A constraint removed during its activation, before it was
+        inserted (see chr.compiler.compile_activate_procedure), is only marked dead.
+        """
         if index in self.constraints:
-            self.trail[-1].append(("constraint_delete", (index, self.constraints[index])))
+            constraint = self.get_constraint(index)
+            suspension = self.builtin.kill(index) if self.builtin is not None else None
+            if self.trailing:
+                self.trail[-1].append(("constraint_delete", (index, constraint, suspension)))
             del self.constraints[index]
-            self.alive_set[index] = False
+            self.remove_from_buckets(constraint, index)
+            self.mark_dead(index)
+        elif index < self.next_id and self.alive(index):
+            self.mark_dead(index)
         else:
             raise Exception(f'constraint with id {index} unknown')
 
-    def get_iterator(self, symbol=None, fix=False):
-        it = self.constraints.items()
-        if symbol:
-            it = filter(lambda c: c[1][0] == symbol, it)
+    def get_iterator(self, symbol=None, fix=False, index=None, key=None):
+        """
+        Iterates over the (id, constraint) pairs in the store.
+        If a signature is given, no snapshot is taken: the constraints are visited in the
+        order of their ids, constraints deleted during the iteration are skipped,
+        and constraints inserted after the start of the iteration are not visited.
+        :param symbol: if given, only constraints with this signature (e.g. "node/3"),
+            or its symbol id, are visited;
+            only the bucket of this signature is touched, not the whole store
+        :param fix: if set to True, the constraints are returned as a list
+        :param index: argument positions of an index declared for symbol (see add_index)
+        :param key: values of the arguments at the positions given by index;
+            only candidates from the according index entry are visited
+        :return: iterable of (id, constraint) pairs
+        """
+        if type(symbol) is str:
+            symbol = self.symbol_ids.get(symbol, symbol)
+        if symbol is not None and index is not None and symbol in self.indexes and index in self.indexes[symbol]:
+            it = self.indexes[symbol][index].lookup(key, self.buckets.get(symbol), self.next_id)
+        elif symbol is not None:
+            it = iterate_buckets(self.next_id, self.buckets.get(symbol))
+        elif self.columnar:
+            it = ((index, self.get_constraint(index)) for index in self.constraints)
+        else:
+            it = self.constraints.items()
         if fix:
             it = list(it)
         return it
 
+    def get_single(self, symbol, index=(), key=(), exclude=()):
+        """
+        Looks up a constraint of a signature with a functional dependency, i.e. one with at
+        most one constraint per value of the arguments at the given positions. Instead of
+        iterating over all candidates, only the first one actually equal to key is returned.
+        If a rule enforcing the dependency has not fired yet, there may be more than one.
+        :param symbol: signature or symbol id of the constraint
+        :param index: argument positions of the key; an index on them has to be declared
+            (see add_index), unless they are empty
+        :param key: values of the arguments at the positions given by index
+        :param exclude: ids of constraints not to return, e.g. those already matched
+        :return: the (id, constraint) pair, or (None, None), if there is no such constraint
+        """
+        if type(symbol) is str:
+            symbol = self.symbol_ids.get(symbol, symbol)
+        if index:
+            return self.indexes[symbol][index].find(key, self.buckets.get(symbol), self.next_id, exclude)
+        for constraint_id, constraint in iterate_buckets(self.next_id, self.buckets.get(symbol)):
+            if constraint_id not in exclude:
+                return constraint_id, constraint
+        return None, None
+
     def dump(self):
-        return list(self.constraints.values())
+        if self.columnar:
+            constraints = [self.get_constraint(index) for index in self.constraints]
+        else:
+            constraints = list(self.constraints.values())
+        if self.symbols:
+            symbols = self.symbols
+            return [
+                (symbols[constraint[0]], *constraint[1:]) if type(constraint[0]) is int else constraint
+                for constraint in constraints
+            ]
+        return constraints
+
+    def export(self, symbol: str):
+        """
+        Exports the constraints with the given signature and int arguments in bulk.
+        :param symbol: signature declared as columnar, e.g. "gcd/1"
+        :return: tuple of the ids and one column per argument (see ColumnarBucket.export)
+        """
+        return self.get_columnar_bucket(symbol).export()
+
+    def select(self, symbol: str, position: int, comparison: str, value: int):
+        """
+        Exports the constraints with the given signature and int arguments in bulk, whose
+        argument at the given position compares to value (see ColumnarBucket.select).
+        :param symbol: signature declared as columnar, e.g. "gcd/1"
+        :return: tuple of the ids and one column per argument
+        """
+        return self.get_columnar_bucket(symbol).select(position, comparison, value)
+
+    def get_columnar_bucket(self, symbol: str) -> ColumnarBucket:
+        bucket = self.buckets.get(self.symbol_ids.get(symbol, symbol))
+        if type(bucket) is not ColumnarBucket:
+            raise ValueError(f'{symbol} is not stored in columns')
+        return bucket
 
 
-def unify(left, right) -> bool:
+ATOMIC_TYPES = frozenset((int, float, complex, str, bytes, bool, type(None)))
+CONTAINER_TYPES = frozenset((tuple, list, dict))
+
+
+def unify(left, right, occurs_check: bool = False) -> bool:
     """
     unifies two values:
         - if either value is a logic variable, the variable is bound to the other value
         - if both values are dict/list/tuple, they are unified elementwise
         - otherwise equality is checked
+    The terms are traversed with an explicit stack, so the nesting depth is not limited by
+    the recursion limit. Identical objects and equal atomic values are accepted before any
+    further type dispatch.
     :param left: one value
     :param right: other value
+    :param occurs_check: if True, a variable is not bound to a term containing it
     :return: True, if the values are unifiable; False otherwise
     """
 
-    if isinstance(left, LogicVariable):
-        if left.is_bound():
-            return unify(left.get_value(), right)
-        return left.set_value(right)
-    if isinstance(right, LogicVariable):
-        if right.is_bound():
-            return unify(left, right.get_value())
-        return right.set_value(left)
-
-    if type(left) is not type(right):
-        return False
+    if left is right:
+        return True
+    if type(left) in ATOMIC_TYPES and type(right) is type(left):
+        return left == right
+
+    stack = [(left, right)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        left, right = pop()
+        if left is right:
+            continue
+
+        left_type = type(left)
+        right_type = type(right)
+        if left_type in ATOMIC_TYPES and right_type is left_type:
+            if left != right:
+                return False
+            continue
+
+        # dereference bound variables to their values
+        if left_type is LogicVariable or isinstance(left, LogicVariable):
+            store = left.store
+            value = store.value_bindings[store.find(left.index)]
+            if value is not UNBOUND:
+                push((value, right))
+                continue
+        elif right_type is LogicVariable or isinstance(right, LogicVariable):
+            store = right.store
+            value = store.value_bindings[store.find(right.index)]
+            if value is not UNBOUND:
+                push((left, value))
+                continue
+            left, right = right, left
+        else:
+            if left_type is not right_type:
+                return False
 
-    if isinstance(left, dict) and isinstance(right, dict):
-        if left.keys() != right.keys():
-            return False
-        for vl, vr in zip(left.values(), right.values()):
-            if not unify(vl, vr):
+            if left_type is tuple or left_type is list:
+                if len(left) != len(right):
+                    return False
+                stack.extend(zip(reversed(left), reversed(right)))
+                continue
+
+            if left_type is dict:
+                if left.keys() != right.keys():
+                    return False
+                stack.extend((left[key], right[key]) for key in reversed(left))
+                continue
+
+            if left != right:
                 return False
+            continue
+
+        # left is an unbound variable
+        if isinstance(right, LogicVariable):
+            store = right.store
+            value = store.value_bindings[store.find(right.index)]
+            if value is not UNBOUND:
+                right = value
+        if occurs_check and not isinstance(right, LogicVariable) and left.occurs_check(right):
+            return False
+        if not left.set_value(right):
+            return False
+
+    return True
+
+
+def equal(left, right) -> bool:
+    """
+    Checks, whether two terms are structurally equal, without binding any variables:
+        - bound variables are compared by their values
+        - unbound variables are only equal to variables of the same class
+        - dict/list/tuple are equal, if they have the same type, the same length and
+          pairwise equal elements
+        - otherwise the values are compared with ==
+    Variables are dereferenced once; the values are then compared by Python's own
+    comparison, which only returns to LogicVariable.__eq__ for nested variables.
+    :param left: one value
+    :param right: other value
+    :return: True, if the values are equal; False otherwise
+    :raises RuntimeError: two variables of different BuiltInStore instances are compared
+    """
+
+    if left is right:
         return True
 
-    if isinstance(left, (list, tuple)) and isinstance(right, (list, tuple)):
-        if len(left) != len(right):
+    if isinstance(left, LogicVariable):
+        store = left.store
+        r_left = store.find(left.index)
+        if isinstance(right, LogicVariable):
+            if right.store is not store:
+                raise RuntimeError("cannot compare variables of different BuiltInStore instances")
+            r_right = store.find(right.index)
+            if r_left == r_right:
+                return True
+            right = store.value_bindings[r_right]
+            if right is UNBOUND:
+                return False
+        left = store.value_bindings[r_left]
+        if left is UNBOUND:
+            return False
+    elif isinstance(right, LogicVariable):
+        store = right.store
+        right = store.value_bindings[store.find(right.index)]
+        if right is UNBOUND:
             return False
-        for vl, vr in zip(left, right):
-            if not unify(vl, vr):
+
+    if type(left) is not type(right) and (type(left) in CONTAINER_TYPES or type(right) in CONTAINER_TYPES):
+        return False
+    try:
+        return left == right
+    except RecursionError:
+        # nested deeper than the recursion limit
+        return equal_iteratively(left, right)
+
+
+def equal_iteratively(left, right) -> bool:
+    """
+    Structural equality like equal, which walks the terms with an explicit stack instead of
+    using Python's comparison of containers, so arbitrarily deep terms can be compared.
+    """
+
+    stack = [(left, right)]
+    pop = stack.pop
+    while stack:
+        left, right = pop()
+        if left is right:
+            continue
+
+        left_type = type(left)
+        right_type = type(right)
+        if left_type in ATOMIC_TYPES and right_type in ATOMIC_TYPES:
+            if left != right:
                 return False
-        return True
+            continue
+
+        if left_type is LogicVariable or isinstance(left, LogicVariable):
+            store = left.store
+            r_left = store.find(left.index)
+            if right_type is LogicVariable or isinstance(right, LogicVariable):
+                if right.store is not store:
+                    raise RuntimeError("cannot compare variables of different BuiltInStore instances")
+                r_right = store.find(right.index)
+                if r_left == r_right:
+                    continue
+                right = store.value_bindings[r_right]
+                if right is UNBOUND:
+                    return False
+                right_type = type(right)
+            left = store.value_bindings[r_left]
+            if left is UNBOUND:
+                return False
+            stack.append((left, right))
+            continue
+
+        if right_type is LogicVariable or isinstance(right, LogicVariable):
+            store = right.store
+            right = store.value_bindings[store.find(right.index)]
+            if right is UNBOUND:
+                return False
+            stack.append((left, right))
+            continue
 
-    return left == right
+        if left_type is tuple or left_type is list:
+            if right_type is not left_type or len(left) != len(right):
+                return False
+            stack.extend(zip(reversed(left), reversed(right)))
+            continue
+
+        if left_type is dict:
+            if right_type is not dict or left.keys() != right.keys():
+                return False
+            stack.extend((left[key], right[key]) for key in left)
+            continue
+
+        if left != right:
+            return False
+
+    return True
 
 
 def get_value(v):
@@ -154,6 +1203,26 @@ def is_bound(v):
     return True
 
 
+def dispatch_key(value):
+    """
+    Computes the key, under which compiled activation procedures look up the occurrences
+    that can match a value (see chr.compiler.dispatch_tag): the type and value of an atomic
+    value, or the type of a tuple or list and the type and value of its atomic first element.
+    Types are part of the key, as head patterns check for the exact type.
+    :param value: dereferenced argument of a constraint
+    :return: hashable key, or None, if the value has no key, e.g. it is an unbound variable,
+        which may still be bound to match any pattern
+    """
+    value_type = type(value)
+    if value_type in ATOMIC_TYPES:
+        return value_type, value
+    if (value_type is tuple or value_type is list) and value:
+        first = value[0]
+        if type(first) in ATOMIC_TYPES:
+            return value_type, type(first), first
+    return None
+
+
 class UnknownVariableError(KeyError):
     """
     Raised, if the given variable index is unknown to the builtin store
@@ -181,51 +1250,79 @@ class BoundVariableError(KeyError):
         self.index = index
 
 
+# value of unbound variables in BuiltInStore.value_bindings
+UNBOUND = object()
+
+
 class BuiltInStore:
 
-    def __init__(self):
-        self.union_find = {}
-        self.value_bindings = {}
+    def __init__(self, trail: bool = True):
+        """
+        :param trail: if set to False, committed bindings are not recorded, and the store
+            cannot backtrack; set_save_point and drop_save_point do nothing
+        """
+        # variable tables, by variable index
+        self.union_find = []
+        # time of the link of every variable, which is not a representative (see find)
+        self.link_times = []
+        self.next_link_time = 0
+        # values of representatives, or UNBOUND
+        self.value_bindings = []
+        # members of union-find classes with more than one variable, by representative
+        self.class_members = {}
         self.next_variable_index = 0
         self.known_names = {}
         self.next_save_point = 0
         self.recent_bindings = []
+        # suspended constraints: (activation, args) by constraint id (see delay)
+        self.suspensions = {}
+        # ids of the constraints suspended on a variable, by variable index
         self.delayed_calls = {}
-        self.next_delay_id = 0
-        self.called_delayed_closures = set()
+        # variables, whose suspended constraints are woken by commit_recent_bindings
+        self.woken_variables = []
+        self.trailing = trail
         self.trail = []
+        # indexes of garbage collected variables (see LogicVariable.__del__ and reclaim),
+        # and of reclaimed ones, which fresh reuses
+        self.released = []
+        self.free_indexes = []
+        self.reclaim_threshold = RECLAIM_BATCH_SIZE
 
     def set_save_point(self):
-        self.trail.append([])
+        if self.trailing:
+            self.trail.append([])
 
     def drop_save_point(self):
-        self.trail.pop()
+        if self.trailing:
+            save_point = self.trail.pop()
+            # the bindings stay undoable by the enclosing save point
+            if self.trail:
+                self.trail[-1] += save_point
 
     def commit_recent_bindings(self):
         """
         Commits recent bindings, i.e. deletes the list of bindings.
         """
 
-        self.trail[-1] += self.recent_bindings
-        recent_bindings = self.recent_bindings
+        if self.trailing:
+            self.trail[-1] += self.recent_bindings
         self.recent_bindings = []
-        for _, index in recent_bindings:
-            self.call_delayed_closures(index)
+        woken_variables = self.woken_variables
+        if woken_variables:
+            self.woken_variables = []
+            self.wake(woken_variables)
 
     def backtrack(self):
         """
         Backtracks one savepoint
         """
+        if not self.trailing:
+            raise Exception('cannot backtrack without trail')
         save_point = self.trail.pop()
         print("REVERTING:", save_point)
 
         while save_point:
-            t, v = save_point.pop()
-            assert t in {"union", "value"}
-            if t == "union":
-                self.union_find[v] = v
-            if t == "value":
-                del self.value_bindings[v]
+            self.undo(*save_point.pop())
 
     def reset_recent_bindings(self):
         """
@@ -233,57 +1330,218 @@ class BuiltInStore:
         :return: None
         """
         while self.recent_bindings:
-            t, v = self.recent_bindings.pop()
-            assert t in {"union", "value", "closure"}
-            if t == "union":
-                self.union_find[v] = v
-            if t == "value":
-                del self.value_bindings[v]
+            self.undo(*self.recent_bindings.pop())
+        self.woken_variables = []
+
+    def undo(self, t: str, v: Any):
+        """
+        Reverts one binding recorded on the trail.
+        """
+        assert t in {"union", "value", "members"}
+        if t == "union":
+            self.union_find[v] = v
+        if t == "value":
+            self.value_bindings[v[0]] = UNBOUND
+        if t == "members":
+            self.split_class_members(*v)
+
+    def redo(self, t: str, v: Any):
+        """
+        Repeats one binding recorded on the trail, after it was reverted by undo.
+        A union is repeated by its "members" record, which link adds right after it.
+        """
+        assert t in {"union", "value", "members"}
+        if t == "value":
+            self.value_bindings[v[0]] = v[1]
+        if t == "members":
+            child, parent, swapped, moved = v
+            self.union_find[child] = parent
+            self.link_times[child] = self.next_link_time
+            self.next_link_time += 1
+            self.merge_class_members(child, parent)
 
     def fresh(self, name: Optional[str] = None, value: Optional[Any] = None) -> 'LogicVariable':
         """
         Generate a fresh logic variable
-        :param name: name of the variable (only for usability/cosmetics)
+        :param name: name of the variable (only for usability/cosmetics); variables without
+            a name are named after their index, when they are printed
         :param value: initial value of the variable
         :return: LogicVariable object, representing the variable
         """
-        assert len(self.union_find) == self.next_variable_index
+        if len(self.released) >= self.reclaim_threshold:
+            self.reclaim()
 
-        variable_index = self.next_variable_index
-        self.next_variable_index += 1
-        variable_name = name
-
-        if not variable_name:
-            variable_name = f"_V{variable_index}"
+        if self.free_indexes:
+            variable_index = self.free_indexes.pop()
         else:
-            if variable_name in self.known_names:
-                variable_name = f"{variable_name}_{self.known_names[variable_name]}"
-                self.known_names[variable_name] += 1
+            variable_index = self.next_variable_index
+            self.next_variable_index += 1
+            self.union_find.append(variable_index)
+            self.link_times.append(0)
+            self.value_bindings.append(UNBOUND)
+
+        if name:
+            if name in self.known_names:
+                self.known_names[name] += 1
+                name = f"{name}_{self.known_names[name]}"
             else:
-                self.known_names[variable_name] = 0
-
-        self.union_find[variable_index] = variable_index
+                self.known_names[name] = 0
 
-        if value:
+        if value is not None:
             self.value_bindings[variable_index] = value
 
-        return LogicVariable(variable_index, variable_name, self)
+        return LogicVariable(variable_index, name, self)
+
+    def fresh_vars(self, n: int) -> List['LogicVariable']:
+        """
+        Generate n fresh, unnamed and unbound logic variables at once.
+        :param n: number of variables
+        :return: list of LogicVariable objects, representing the variables
+        """
+        if len(self.released) >= self.reclaim_threshold:
+            self.reclaim()
+
+        reused = self.free_indexes[-n:] if n > 0 else []
+        del self.free_indexes[len(self.free_indexes) - len(reused):]
+
+        indexes = list(range(self.next_variable_index, self.next_variable_index + n - len(reused)))
+        self.next_variable_index += len(indexes)
+        self.union_find += indexes
+        self.link_times += [0] * len(indexes)
+        self.value_bindings += [UNBOUND] * len(indexes)
+
+        return [LogicVariable(index, None, self) for index in reused + indexes]
+
+    def reclaim(self):
+        """
+        Frees the indexes of the variables, which were garbage collected, for reuse by fresh.
+        A variable has no LogicVariable object left, once no constraint, suspension, value
+        or handle of the user refers to it. Variables in a class with other variables are
+        only freed together with the whole class, as the union-find links of the others
+        may lead through them.
+        Stores with a trail never reclaim variables, since the trail refers to them by index;
+        neither do they while bindings are not committed yet.
+        """
+        if self.trailing or self.recent_bindings or self.woken_variables:
+            return
+
+        released = set(self.released)
+        self.released = []
+        pending = []
+        # members freed with their class already lost their links to the representative
+        freed = set()
+        for index in released:
+            if index in freed:
+                continue
+            r = self.find(index)
+            members = self.class_members.get(r)
+            if members is None:
+                self.free(index)
+            elif not all(member in released for member in members):
+                pending.append(index)
+            elif index == r:
+                del self.class_members[r]
+                for member in members:
+                    self.free(member)
+                freed.update(members)
+        self.released += pending
+        self.reclaim_threshold = max(RECLAIM_BATCH_SIZE, 2 * len(pending))
+
+    def free(self, index: int):
+        self.union_find[index] = index
+        self.link_times[index] = 0
+        # releases the variables in the value as well
+        self.value_bindings[index] = UNBOUND
+        self.delayed_calls.pop(index, None)
+        self.free_indexes.append(index)
 
     def find(self, index: int) -> int:
         """
-        Find the representative if the given index in the union-find structure
+        Find the representative if the given index in the union-find structure.
+        The path is compressed, as far as undoing links stays correct: a variable is only
+        linked to the representative directly, if all links it skips are older than its own,
+        since then they can only be undone after its own link, which resets the variable.
         :param index: index to find the representative of
         :return: representative index of the given index
         """
-        assert index in self.union_find
-
-        idx = index
-        r = self.union_find[idx]
-        while idx != r:
-            idx, r = r, self.union_find[r]
+        union_find = self.union_find
+        parent = union_find[index]
+        if parent == index or union_find[parent] == parent:
+            return parent
+
+        path = [index, parent]
+        r = union_find[parent]
+        while union_find[r] != r:
+            path.append(r)
+            r = union_find[r]
+
+        link_times = self.link_times
+        newest = link_times[path[-1]]
+        for idx in reversed(path[:-1]):
+            time = link_times[idx]
+            if time > newest:
+                union_find[idx] = r
+                newest = time
 
         return r
 
+    def get_class_members(self, index: int) -> List[int]:
+        """
+        Retrieve the indices of all variables, which are unioned with the given one
+        :param index: index of the variable
+        :return: list of variable indices in the class of the given variable (including itself)
+        """
+        r = self.find(index)
+        if r in self.class_members:
+            return self.class_members[r]
+        return [r]
+
+    def link(self, child: int, parent: int):
+        """
+        Makes parent the representative of the class of child, and merges the member lists
+        of both classes, by moving the members of the smaller class into the list of the
+        larger one.
+        :param child: representative of one class
+        :param parent: representative of the other class
+        """
+        self.union_find[child] = parent
+        self.link_times[child] = self.next_link_time
+        self.next_link_time += 1
+        self.recent_bindings.append(("union", child))
+        swapped, moved = self.merge_class_members(child, parent)
+        self.recent_bindings.append(("members", (child, parent, swapped, moved)))
+
+    def merge_class_members(self, child: int, parent: int) -> Tuple[bool, int]:
+        """
+        Merges the member lists of the classes of child and parent.
+        :return: whether the list of child was kept, and the number of members moved
+        """
+        child_members = self.class_members.pop(child, None) or [child]
+        parent_members = self.class_members.get(parent, None) or [parent]
+
+        if len(child_members) > len(parent_members):
+            child_members += parent_members
+            self.class_members[parent] = child_members
+            return True, len(parent_members)
+
+        parent_members += child_members
+        self.class_members[parent] = parent_members
+        return False, len(child_members)
+
+    def split_class_members(self, child: int, parent: int, swapped: bool, moved: int):
+        """
+        Reverts the merge of member lists done by link(child, parent).
+        """
+        members = self.class_members.pop(parent)
+        tail = members[-moved:]
+        del members[-moved:]
+
+        child_members, parent_members = (members, tail) if swapped else (tail, members)
+        if len(child_members) > 1:
+            self.class_members[child] = child_members
+        if len(parent_members) > 1:
+            self.class_members[parent] = parent_members
+
     def union(self, a: int, b: int) -> bool:
         """
         Union two variable indices, with respect to value binding
@@ -291,8 +1549,8 @@ class BuiltInStore:
         :param b: second variable index
         :return: True, if the variables were unioned successfully; False otherwise.
         """
-        assert a in self.union_find
-        assert b in self.union_find
+        assert 0 <= a < len(self.union_find)
+        assert 0 <= b < len(self.union_find)
 
         # Find representative of both variables
         r_a = self.find(a)
@@ -302,37 +1560,35 @@ class BuiltInStore:
         #   - the variables are not equal to begin with
         #   - and not already bound to one another
         if r_a != r_b:
+            bound_a = self.value_bindings[r_a] is not UNBOUND
+            bound_b = self.value_bindings[r_b] is not UNBOUND
             # If both variables are already bound to a value, the values must be unifiable
-            if r_a in self.value_bindings and r_b in self.value_bindings:
-                u = unify(self.value_bindings[r_a], self.value_bindings[r_b])
-                # if the values are unifiable, union them
-                # and return True
-                if u:
-                    self.union_find[r_a] = r_b
-                    self.recent_bindings.append(("union", r_a))
-                    return True
-                # return false otherwise
+            if bound_a and bound_b and not unify(self.value_bindings[r_a], self.value_bindings[r_b]):
                 return False
-            # if only one of the variables is bound, set the
-            # bound one as representative of the unbound one
-            if r_a in self.value_bindings:
-                self.union_find[r_b] = r_a
-                self.recent_bindings.append(("union", r_b))
-                self.value_bindings[r_b] = self.value_bindings[r_a]
-                self.recent_bindings.append(("value", r_b))
-                return True
-            if r_b in self.value_bindings:
-                self.union_find[r_a] = r_b
-                self.recent_bindings.append(("union", r_a))
-                self.value_bindings[r_a] = self.value_bindings[r_b]
-                self.recent_bindings.append(("value", r_a))
-                return True
-            # If neither variable is bound, union them
-            self.union_find[r_a] = r_b
-            self.recent_bindings.append(("union", r_a))
+            # union by size: the representative of the larger class stays representative
+            if self.class_size(r_a) > self.class_size(r_b):
+                r_a, r_b, bound_a, bound_b = r_b, r_a, bound_b, bound_a
+            # the constraints suspended on an unbound class are woken, if it gets a value;
+            # otherwise the ones on the smaller class, which see the variables of the other
+            self.woken_variables += self.get_class_members(r_b if bound_a and not bound_b else r_a)
+            self.link(r_a, r_b)
+            # if only the linked variable is bound, its value is the value of the union
+            if bound_a and not bound_b:
+                value = self.value_bindings[r_a]
+                self.value_bindings[r_b] = value
+                self.recent_bindings.append(("value", (r_b, value)))
         # If the variables are already in a union, return True
         return True
 
+    def class_size(self, r: int) -> int:
+        """
+        :param r: representative of a class
+        :return: number of variables in the class
+        """
+        if r in self.class_members:
+            return len(self.class_members[r])
+        return 1
+
     def get_value(self, index: int) -> Optional[Any]:
         """
         Retrieve the value of a variable, if it is bound.
@@ -340,10 +1596,10 @@ class BuiltInStore:
         :return: the value of the variable, if it is bound; None otherwise
         """
 
-        r = self.find(index)
-        if r in self.value_bindings:
-            return self.value_bindings[r]
-        return None
+        value = self.value_bindings[self.find(index)]
+        if value is UNBOUND:
+            return None
+        return value
 
     def set_value(self, index: int, value: Any) -> None:
         """
@@ -353,13 +1609,14 @@ class BuiltInStore:
         :return: None
         :raises BoundVariableException: variable is already bound
         """
-        if index in self.value_bindings:
-            if self.get_value(index) == value:
+        r = self.find(index)
+        if self.value_bindings[r] is not UNBOUND:
+            if self.value_bindings[r] == value:
                 return
             raise BoundVariableError(index)
-        r = self.find(index)
         self.value_bindings[r] = value
-        self.recent_bindings.append(("value", r))
+        self.recent_bindings.append(("value", (r, value)))
+        self.woken_variables += self.get_class_members(r)
 
     def is_bound(self, index: int) -> bool:
         """
@@ -367,35 +1624,73 @@ class BuiltInStore:
         :param index: index of the variable to check
         :return: True, if the variable is bound; false otherwise
         """
-        if index not in self.union_find:
+        if not 0 <= index < len(self.union_find):
             raise UnknownVariableError(index)
 
-        return index in self.value_bindings
+        return self.value_bindings[self.find(index)] is not UNBOUND
 
-    def delay(self, closure: Callable, *args: Any):
+    def delay(self, index: int, activation: Callable, args: tuple):
         """
-        delayes the call of a closure until an unbound variable in its arguments is set
-        :param closure: closure to delay
-        :param args: arguments of the closure
+        Suspends a constraint on the unbound variables among its arguments: whenever one of
+        their classes is bound or unioned with another one, the constraint is woken.
+        :param index: id of the constraint; it has one suspension at most
+        :param activation: wake procedure, called with index, a bit mask of the positions
+            of the woken variables in args, and args
+        :param args: arguments of the constraint
         """
+        self.suspensions[index] = activation, args
+        delayed_calls = self.delayed_calls
         for arg in args:
-            i = self.next_delay_id
             if isinstance(arg, LogicVariable) and not arg.is_bound():
-                if arg.index in self.delayed_calls:
-                    self.delayed_calls[arg.index].append((i, closure))
+                if arg.index in delayed_calls:
+                    ids = delayed_calls[arg.index]
+                    ids.append(index)
+                    # drop the ids of killed suspensions, whenever the list doubles its size
+                    if len(ids) >= 8 and len(ids) & (len(ids) - 1) == 0:
+                        delayed_calls[arg.index] = self.live_suspensions(ids)
                 else:
-                    self.delayed_calls[arg.index] = [(i, closure)]
+                    delayed_calls[arg.index] = [index]
+
+    def kill(self, index: int) -> Optional[Tuple[Callable, tuple]]:
+        """
+        Removes the suspension of a constraint, e.g. when it is deleted.
+        :param index: id of the constraint
+        :return: the removed suspension, i.e. the activation and the arguments, if any
+        """
+        return self.suspensions.pop(index, None)
 
-    def call_delayed_closures(self, index: int):
+    def live_suspensions(self, ids: List[int]) -> List[int]:
+        suspensions = self.suspensions
+        return list(dict.fromkeys(i for i in ids if i in suspensions))
+
+    def wake(self, variables: Iterable[int]):
         """
-        Tries to call all delayed closures associated with the given variable index
-        :param index: variable index
+        Calls the wake procedures of the constraints suspended on the given variables,
+        once for each constraint.
+        :param variables: variable indices
         """
-        if index in self.delayed_calls:
-            for i, closure in self.delayed_calls[index]:
-                if i not in self.called_delayed_closures:
-                    if closure():
-                        self.called_delayed_closures.add(i)
+        variables = set(variables)
+        delayed_calls = self.delayed_calls
+        woken = {}
+        for variable in variables:
+            if variable in delayed_calls:
+                ids = self.live_suspensions(delayed_calls[variable])
+                if ids:
+                    delayed_calls[variable] = ids
+                    woken.update(dict.fromkeys(ids))
+                else:
+                    del delayed_calls[variable]
+
+        suspensions = self.suspensions
+        for index in woken:
+            # the constraint may have been deleted by a previous activation
+            if index in suspensions:
+                activation, args = suspensions[index]
+                positions = 0
+                for i, arg in enumerate(args):
+                    if isinstance(arg, LogicVariable) and arg.index in variables:
+                        positions |= 1 << i
+                activation(index, positions, *args)
 
 
 class LogicVariable:
@@ -403,18 +1698,27 @@ class LogicVariable:
     An interface to a specific logic variable, managed by the builtin store.
     """
 
-    def __init__(self, index: int, name: str, store: BuiltInStore):
+    __slots__ = ("index", "given_name", "store")
+
+    def __init__(self, index: int, name: Optional[str], store: BuiltInStore):
         """
         Create a logic variable with the given index and name, and a back reference to the
         BuiltInStore instance, which created it.
         :param index: index of the variable in the store
-        :param name: name of the variable (for usability/cosmetic purposes)
+        :param name: name of the variable (for usability/cosmetic purposes), or None
         :param store: back reference to the BuiltInStore instance, that created this variable
         """
         self.index = index
-        self.name = name
+        self.given_name = name
         self.store = store
 
+    @property
+    def name(self) -> str:
+        """
+        :return: the name given to the variable, or one derived from its index
+        """
+        return self.given_name or f"_V{self.index}"
+
     def __str__(self):
         return f"{self.name}{f'={self.get_value()}' if self.is_bound() else ''}@{self.index}"
 
@@ -435,53 +1739,24 @@ class LogicVariable:
         """
         return self.store.is_bound(self.index)
 
-    def __get_representative(self) -> int:
-        return self.store.find(self.index)
-
     def __eq__(self, other: Any) -> bool:
         """
         Checks, whether the variable is equal to the given object, i.e.:
             - if the other object is a variable:
-                - they are the same variable (i.e. same index)
-                - they are bound to the same value (referentially)
-            - the other object is the value, which this object is bound to (referentially)
+                - they are the same variable or unioned
+                - they are bound to structurally equal values
+            - the other object is structurally equal to the value, which this object is bound to
         :param other: other object
         :return: True, if the object is equal (see above) to the variable; False otherwise
         :raises RuntimeError: the other value is a logic variable of another BuiltInStore instance.
         """
+        return equal(self, other)
 
-        if isinstance(other, LogicVariable):
-            if self.store is not other.store:
-                raise RuntimeError("cannot call __eq__ for variables of different BuiltInStore instances")
-
-            if self is other:
-                return True
-
-            if self.__get_representative() == other.__get_representative():
-                return True
-
-            if self.is_bound() and other.is_bound():
-                if type(self.get_value()) is not type(other.get_value()):
-                    return False
-                if isinstance(self.get_value(), dict):
-                    if self.get_value().keys() != other.get_value().keys():
-                        return False
-                    return all(
-                        l == r
-                        for l, r
-                        in zip(self.get_value().values(), other.get_value().values())
-                    )
-                if isinstance(self.get_value(), (list, tuple)):
-                    return all(
-                        l == r
-                        for l, r
-                        in zip(self.get_value(), other.get_value())
-                    )
-                return self.get_value() == other.get_value()
-
-            return False
-
-        return self.get_value() == other
+    def __del__(self):
+        # the index is reclaimed by the store, unless the trail may still refer to it
+        store = self.store
+        if not store.trailing:
+            store.released.append(self.index)
 
     def set_value(self, value: Any) -> bool:
         """
@@ -500,41 +1775,183 @@ class LogicVariable:
         return True
 
     def occurs_check(self, term) -> bool:
-        if self is term:
-            return True
-        if isinstance(term, (tuple, list)):
-            return any(self.occurs_check(sub_term) for sub_term in term)
-        if isinstance(term, dict):
-            return any(self.occurs_check(sub_term) for sub_term in term.values())
+        """
+        Check, if this variable occurs in the given term, following bound variables.
+        :param term: term to search
+        :return: True, if the term contains this variable or a variable unioned with it
+        """
+        store = self.store
+        representative = store.find(self.index)
+        stack = [term]
+        while stack:
+            term = stack.pop()
+            if isinstance(term, LogicVariable):
+                if term.store is store:
+                    r = store.find(term.index)
+                    if r == representative:
+                        return True
+                    value = store.value_bindings[r]
+                    if value is not UNBOUND:
+                        stack.append(value)
+            elif isinstance(term, (tuple, list)):
+                stack.extend(term)
+            elif isinstance(term, dict):
+                stack.extend(term.values())
         return False
 
 
+class Version:
+    """
+    State of a forked solver, as a node in a tree of states (see CHRSolver.fork).
+    The changes from the state of the parent are the undo records on the trails of the node,
+    which are the trails of the stores, while the node is checked out.
+    """
+
+    def __init__(self, parent: Optional['Version'] = None):
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.builtin_trail = [[]]
+        self.chr_trail = [[]]
+
+
 class CHRSolver:
+    rule_names = []
+    # signatures of the constraints by symbol id, i.e. the first element of their tuples
+    symbols = []
+    indexes = []
+    columnar = []
 
-    def __init__(self):
-        self.builtin, self.chr = BuiltInStore(), CHRStore()
+    def __init__(self, trail: bool = True, intern: bool = False):
+        """
+        :param trail: if set to False, the solver records no undo information, which saves
+            time and memory for programs that never backtrack; backtrack cannot be called then
+        :param intern: if set to True, equal ground terms in the stored constraints are
+            shared, which saves memory for programs with many copies of the same terms
+        """
+        self.builtin = BuiltInStore(trail=trail)
+        self.chr = CHRStore(
+            self.indexes,
+            trail=trail,
+            columnar=self.columnar,
+            builtin=self.builtin,
+            intern=intern,
+            symbols=self.symbols
+        )
+        self.version = None
+
+    def fork(self) -> 'CHRSolver':
+        """
+        Creates an independent copy of the solver in its current state, in constant time.
+        The solver and all its forks share their stores, which represent the state of one
+        of them at a time: before a solver is used, its state is checked out, by undoing
+        the changes of the current state, and redoing its own ones, back to their common
+        ancestor state. So each fork only pays for the changes it makes.
+        Variables are shared as well: their values are the ones in the state of the solver,
+        that was used last (see checkout).
+        Neither the solver nor the fork can backtrack beyond the point of the fork.
+        :return: the new solver
+        """
+        if not self.chr.trailing:
+            raise Exception('cannot fork without trail')
+
+        self.checkout()
+        if self.version is None:
+            self.version = Version()
+            self.version.builtin_trail, self.version.chr_trail = self.builtin.trail, self.chr.trail
+            self.chr.version = self.version
+
+        base = self.version
+        forked = copy(self)
+        forked.version = Version(base)
+        self.version = Version(base)
+        self.checkout()
+        return forked
+
+    def checkout(self):
+        """
+        Makes the stores, which are shared with the forks of the solver, represent the state
+        of this solver (see fork).
+        """
+        current, target = self.chr.version, self.version
+        if current is target:
+            return
+
+        undone, redone = [], []
+        while current.depth > target.depth:
+            undone.append(current)
+            current = current.parent
+        while target.depth > current.depth:
+            redone.append(target)
+            target = target.parent
+        while current is not target:
+            undone.append(current)
+            redone.append(target)
+            current, target = current.parent, target.parent
+
+        for version in undone:
+            for save_point in reversed(version.builtin_trail):
+                for record in reversed(save_point):
+                    self.builtin.undo(*record)
+            for save_point in reversed(version.chr_trail):
+                for record in reversed(save_point):
+                    self.chr.undo(*record)
+
+        for version in reversed(redone):
+            for save_point in version.builtin_trail:
+                for record in save_point:
+                    self.builtin.redo(*record)
+            for save_point in version.chr_trail:
+                for record in save_point:
+                    self.chr.redo(*record)
+
+        self.builtin.trail, self.chr.trail = self.version.builtin_trail, self.version.chr_trail
+        self.chr.version = self.version
 
     def fresh_var(self, name: Optional[str] = None, value: Optional[Any] = None) -> LogicVariable:
+        self.checkout()
         return self.builtin.fresh(name=name, value=value)
 
+    def fresh_vars(self, n: int) -> List[LogicVariable]:
+        self.checkout()
+        return self.builtin.fresh_vars(n)
+
     def dump_chr_store(self):
+        self.checkout()
         return self.chr.dump()
 
+    def dump_columns(self, symbol: str):
+        self.checkout()
+        return self.chr.export(symbol)
+
+    def select_columns(self, symbol: str, position: int, comparison: str, value: int):
+        self.checkout()
+        return self.chr.select(symbol, position, comparison, value)
+
+    def history_size(self):
+        self.checkout()
+        return self.chr.history_size()
+
     def set_save_point(self):
+        # called on entry of every public constraint procedure
+        self.checkout()
         self.builtin.set_save_point()
         self.chr.set_save_point()
 
     def drop_save_point(self):
+        self.checkout()
         self.builtin.drop_save_point()
         self.chr.drop_save_point()
 
     def backtrack(self):
+        self.checkout()
         self.builtin.backtrack()
         self.chr.backtrack()
 
-    def unify(self, a, b):
+    def unify(self, a, b, occurs_check: bool = False):
         self.set_save_point()
-        if not unify(a, b):
-            self.builtin.commit_recent_bindings()
+        result = unify(a, b, occurs_check)
+        # wakes the constraints suspended on the bound variables
+        self.builtin.commit_recent_bindings()
+        if not result:
             raise CHRFalse()
 
@@ -3,7 +3,7 @@ from random import sample
 
 import pytest
 
-from chr.runtime import CHRFalse, UndefinedConstraintError, unify
+from chr.runtime import CHRFalse, UndefinedConstraintError, unify, get_value
 
 
 def test_sum_solver():
@@ -158,6 +158,76 @@ def test_backtrack():
     assert r == fib(11)
 
 
+def test_late_storage():
+    from test_files.fibonacci import Fibonacci
+
+    solver = Fibonacci()
+
+    r = solver.fresh_var()
+    solver.fib(10)
+    solver.read(r)
+    assert r == fib(10)
+
+    # fib/1 is removed by its first applicable occurrence and therefore never stored
+    inserted = [value[1] for entries in solver.chr.trail for action, value in entries if action == "constraint_insert"]
+    assert inserted
+    assert all(constraint[0] != 0 for constraint in inserted)
+
+    solver.backtrack()
+    solver.backtrack()
+    assert not solver.dump_chr_store()
+
+
+def test_without_trail():
+    from test_files.fibonacci import Fibonacci
+
+    solver = Fibonacci(trail=False)
+
+    for n in range(1, 15):
+        solver.fib(n)
+        r = solver.fresh_var()
+        solver.read(r)
+        assert r == fib(n)
+
+    assert solver.chr.trail == [[]]
+    assert not solver.builtin.trail
+
+    with pytest.raises(Exception):
+        solver.backtrack()
+
+
+def test_fork():
+    from test_files.fibonacci import Fibonacci
+
+    solver = Fibonacci()
+    solver.fib(5)
+    r = solver.fresh_var()
+
+    a = solver.fork()
+    b = solver.fork()
+    a.fib(3)
+    b.fib(4)
+    b.read(r)
+    assert r == fib(4) + fib(5)
+
+    assert a.dump_chr_store() == [("result/1", fib(3) + fib(5))]
+    assert not r.is_bound()
+    assert b.dump_chr_store() == []
+    assert r == fib(4) + fib(5)
+    assert solver.dump_chr_store() == [("result/1", fib(5))]
+
+    c = a.fork()
+    c.read(r)
+    assert r == fib(3) + fib(5)
+    a.fib(1)
+    a.read(r)
+    assert r == fib(1) + fib(3) + fib(5)
+
+    a.backtrack()
+    assert not r.is_bound()
+    assert a.dump_chr_store() == [("result/1", fib(1) + fib(3) + fib(5))]
+
+
 def test_match():
     from test_files.match_solver import MatchTest
 
@@ -170,6 +240,42 @@ def test_match():
     assert x != y
     assert len(solver.dump_chr_store()) == 2
 
+    # structured values are compared structurally, through bound variables
+    z = solver.fresh_var()
+    solver.match((1, [z, {"a": 2}]))
+    solver.match((1, [z, {"a": 2}, 3]))
+    assert len(solver.dump_chr_store()) == 4
+
+    w = solver.fresh_var()
+    solver.unify(w, z)
+    solver.match((1, [w, {"a": 2}]))
+    assert len(solver.dump_chr_store()) == 4
+
+
+def test_ground_pattern_types():
+    from chr.compiler import chr_compile_source
+
+    code = chr_compile_source("""class GroundPatternTest.
+
+constraints c/1.
+
+c((1, "a")) <=> True.
+c(("b", [2, {"k": 3}])) <=> True.
+""")
+    namespace = {}
+    exec(code, namespace)
+    solver = namespace["GroundPatternTest"]()
+
+    # equal values of other types do not match, like in a node by node match
+    look_alikes = [(True, "a"), (1.0, "a"), ("b", [2.0, {"k": 3}]), ("b", [2, {"k": 3.0}]), ("b", [True, {"k": 3}])]
+    for value in look_alikes:
+        solver.c(value)
+    assert len(solver.dump_chr_store()) == len(look_alikes)
+
+    solver.c((1, "a"))
+    solver.c(("b", [2, {"k": 3}]))
+    assert len(solver.dump_chr_store()) == len(look_alikes)
+
 
 def test_gcd():
     from test_files.gcd_solver import GCDSolver
@@ -198,6 +304,37 @@ def test_gcd():
     assert ("gcd/1", 1) in dump
 
 
+def test_gcd_columnar():
+    from test_files.gcd_solver import GCDSolver
+    from test_files.fibonacci import Fibonacci
+
+    # only declared constraints are kept in columns
+    assert GCDSolver.columnar == ["gcd/1"]
+    assert Fibonacci.columnar == []
+
+    solver = GCDSolver()
+    solver.gcd(9)
+    solver.gcd(6)
+    ids, (values,) = solver.dump_columns("gcd/1")
+    assert list(values) == [3]
+    assert solver.dump_chr_store() == [("gcd/1", 3)]
+    assert list(solver.select_columns("gcd/1", 0, ">", 3)[0]) == []
+
+
+def test_gcd_late_binding():
+    from test_files.gcd_solver import GCDSolver
+
+    solver = GCDSolver()
+    x, y = solver.fresh_var(), solver.fresh_var()
+    solver.gcd(x)
+    solver.gcd(y)
+    assert len(solver.dump_chr_store()) == 2
+
+    solver.unify(x, 9)
+    solver.unify(y, 6)
+    assert [get_value(c[1]) for c in solver.dump_chr_store()] == [3]
+
+
 def test_length():
     from test_files.length import LengthSolver
 
@@ -425,6 +562,186 @@ def test_propagation_history():
     assert ("c/0",) not in dump
 
 
+def test_join_order():
+    from test_files import join_order
+    from test_files.join_order import JoinOrderTest
+    from chr.compiler import plan_join
+    from chr.parser import chr_parse
+
+    with open(join_order.__file__[:-len(".py")] + ".chr") as source:
+        program = chr_parse(source.read()).get_normal_form().omega_r()
+
+    # with mark/1 active, edge($X, $Y) is looked up by $X before edge($Y, $Z) by $Y,
+    # instead of scanning all edges for edge($Y, $Z) first
+    plan = plan_join(next(program.rules[0].get_occurrence_schemes()))
+    assert [(idx, index_positions) for idx, _, index_positions, _ in plan] == [(2, (0,)), (1, (0,))]
+
+    solver = JoinOrderTest()
+    for i in range(4):
+        solver.edge(i, i + 1)
+    solver.mark(0)
+    solver.mark(2)
+
+    dump = solver.dump_chr_store()
+    assert ("path/2", 0, 2) in dump
+    assert ("path/2", 2, 4) in dump
+    assert len([c for c in dump if c[0] == "path/2"]) == 2
+
+
+def test_early_guard():
+    from chr.compiler import chr_compile_source
+
+    source = """class EarlyGuardTest.
+
+constraints a/1, b/1, c/1.
+
+a($X), b($Y), c($Z) ==> $Y > $X, is_bound($X), $X > 1, not is_bound($Z) | c($Y).
+"""
+    code = chr_compile_source(source)
+    occurrence = code[code.index("def __a_1_0"):code.index("def __b_1_0")]
+
+    # checks on $X are moved before the loops, the cheapest first; 'not' stays in the guard
+    assert occurrence.index("is_bound(get_value(X))") < occurrence.index("> get_value(1)") \
+        < occurrence.index("get_iterator")
+    assert occurrence.index("get_iterator") < occurrence.index("not is_bound")
+
+    namespace = {}
+    exec(code, namespace)
+    solver = namespace["EarlyGuardTest"]()
+    solver.b(1)
+    solver.b(3)
+    solver.c(solver.fresh_var())
+    solver.a(2)
+    solver.a(0)
+
+    dump = solver.dump_chr_store()
+    assert ("c/1", 3) in dump
+    assert ("c/1", 1) not in dump
+
+    # checks, that may raise, stay in the guard, so they are not tried without partners
+    code = chr_compile_source("""class RaisingGuardTest.
+
+constraints a/1, b/1, out/1.
+
+a($X), b($Y) ==> 10 / $X > 1 | out($Y).
+a($X), b($Y) ==> $X + 1 > 2 | out($Y).
+""")
+    namespace = {}
+    exec(code, namespace)
+    solver = namespace["RaisingGuardTest"]()
+    solver.a(solver.fresh_var())
+    solver.a(0)
+    assert len(solver.dump_chr_store()) == 2
+
+
+def test_dispatch():
+    from test_files.dispatch import DispatchTest
+
+    solver = DispatchTest()
+    assert solver.indexes == [("pair/2", (0,))]
+
+    solver.c(True)
+    solver.c(1)
+    solver.c(("tag", 5))
+    solver.c(["tag", 6])
+    solver.c(solver.fresh_var())
+
+    dump = solver.dump_chr_store()
+    assert ("seen/1", "bool") in dump
+    assert ("seen/1", "int") in dump
+    assert ("seen/1", 5) in dump
+    assert len([c for c in dump if c == ("seen/1", "other")]) == 2
+
+    solver = DispatchTest()
+    solver.pair("int", 1)
+    solver.pair("bool", 2)
+    solver.seen(0)
+    dump = solver.dump_chr_store()
+    assert ("seen/1", 2) in dump
+    assert ("pair/2", "int", 1) in dump
+
+    # an argument bound by an earlier occurrence is dispatched on its value
+    from chr.compiler import chr_compile_source
+
+    code = chr_compile_source("""class BindingDispatchTest.
+
+constraints c/1, d/1.
+
+c($X) ==> $X = 1.
+c(1) <=> d("one").
+c(2) <=> d("two").
+""")
+    namespace = {}
+    exec(code, namespace)
+    solver = namespace["BindingDispatchTest"]()
+    solver.c(solver.fresh_var())
+    assert solver.dump_chr_store() == [("d/1", "one")]
+
+
+def test_functional_dependencies():
+    from chr.compiler import functional_dependencies, chr_compile_source, CHRCompilationError
+    from chr.parser import chr_parse
+    from test_files import leq_solver, condition_simplifier
+
+    def dependencies(module):
+        with open(module.__file__[:-len(".py")] + ".chr") as source:
+            return functional_dependencies(chr_parse(source.read()).get_normal_form().omega_r())
+
+    # only declared keys, rules like "idempotence" admit duplicates until they fired
+    assert dependencies(leq_solver) == set()
+    assert dependencies(condition_simplifier) == {("node/3", (1,)), ("node/2", (1,))}
+
+    code = chr_compile_source("""class KeyTest.
+
+constraints val/2, query/2.
+
+keys val/2(0).
+
+val($K, $V) \\ query($K, $Out) <=> $Out = $V.
+""")
+    assert "get_single(symbol=0, index=(0,)" in code
+
+    namespace = {}
+    exec(code, namespace)
+    solver = namespace["KeyTest"]()
+    solver.val(1, "a")
+    solver.val(2, "b")
+    out = solver.fresh_var()
+    solver.query(2, out)
+    assert out == "b"
+
+    # typos in key declarations are reported
+    for declaration in ["keys vals/2(0).", "keys val/2(2)."]:
+        with pytest.raises(CHRCompilationError):
+            chr_compile_source(f"""class KeyTest.
+
+constraints val/2.
+
+{declaration}
+
+val($K, $V) \\ val($K, $W) <=> True.
+""")
+
+    # all duplicates are found, before the simpagation rule removes one of them
+    code = chr_compile_source("""class DuplicateTest.
+
+constraints c/2, d/1, out/1.
+
+c($K, $V), d($K) ==> out($V).
+c($K, $V) ==> d($K).
+c($K, $A) \\ c($K, $B) <=> True.
+""")
+    assert "get_single" not in code
+
+    namespace = {}
+    exec(code, namespace)
+    solver = namespace["DuplicateTest"]()
+    solver.c(1, "a")
+    solver.c(1, "b")
+    outs = [args[0] for symbol, *args in solver.dump_chr_store() if symbol == "out/1"]
+    assert sorted(outs) == ["a", "a", "b", "b"]
+
+
 def dpll(formula, solver):
     if not formula:
         return True
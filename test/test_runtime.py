@@ -1,3 +1,6 @@
+import gc
+import sys
+
 import chr.runtime as rt
 
 
@@ -79,6 +82,90 @@ def test_unify_cycle():
     assert store.find(b.index) == b.index
 
 
+def test_deep_unification():
+    store = rt.BuiltInStore()
+    x = store.fresh()
+    left, right = x, "leaf"
+    for i in range(20000):
+        left = ("if", i, left, [])
+        right = ("if", i, right, [])
+
+    # deeper than the recursion limit
+    assert rt.unify(left, right)
+    assert x == "leaf"
+    assert rt.unify({1: x, 2: 3}, {2: 3, 1: "leaf"})
+    assert not rt.unify(left, ("if", 19999, right, [1]))
+
+
+def test_equal():
+    store = rt.BuiltInStore()
+    x, y, z = store.fresh(), store.fresh(), store.fresh()
+
+    assert not rt.equal(x, y)
+    assert not rt.equal(x, 1)
+    assert not rt.equal([x, 1], [x])
+    assert rt.unify(x, y)
+    assert rt.equal(x, y)
+    assert rt.unify(z, [1, {"a": (2, 3)}])
+    assert rt.equal([x, z], [y, [1, {"a": (2, 3)}]])
+    assert not rt.equal(z, [1, {"a": [2, 3]}])
+    assert not rt.equal(z, [1, {"a": (2, 3)}, 4])
+    assert z == [1, {"a": (2, 3)}]
+    assert z != [1, {"a": (2, 3)}, 4]
+
+    # deeper than the recursion limit
+    left, right = x, y
+    for i in range(20000):
+        left, right = (i, left), (i, right)
+    assert rt.equal(left, right)
+    assert not rt.equal(left, (0, right))
+
+
+def test_variable_reclamation():
+    store = rt.BuiltInStore(trail=False)
+    for i in range(10 * rt.RECLAIM_BATCH_SIZE):
+        x = store.fresh()
+        assert rt.unify(x, (i, store.fresh()))
+        store.commit_recent_bindings()
+    assert len(store.union_find) < 3 * rt.RECLAIM_BATCH_SIZE
+
+    # classes are only freed as a whole
+    x, y = store.fresh(), store.fresh()
+    assert rt.unify(x, y)
+    store.commit_recent_bindings()
+    x_index = x.index
+    del x
+    store.reclaim()
+    assert x_index not in store.free_indexes
+    assert rt.unify(y, 1)
+    store.commit_recent_bindings()
+    del y
+    store.reclaim()
+    assert x_index in store.free_indexes
+    z = store.fresh()
+    assert not z.is_bound()
+    assert store.find(z.index) == z.index
+
+    # each member of a class is freed once, whichever member represents it
+    store = rt.BuiltInStore(trail=False)
+    a, b, c = store.fresh(), store.fresh(), store.fresh()
+    assert rt.unify(a, b)
+    assert rt.unify(b, c)
+    store.commit_recent_bindings()
+    del a, b, c
+    gc.collect()
+    store.reclaim()
+    assert sorted(store.free_indexes) == [0, 1, 2]
+    assert len({v.index for v in store.fresh_vars(5)}) == 5
+
+    # a trail refers to variables by index
+    store = rt.BuiltInStore()
+    x = store.fresh()
+    del x
+    store.reclaim()
+    assert not store.free_indexes
+
+
 def test_ask_eq():
     store = rt.BuiltInStore()
 
@@ -121,8 +208,383 @@ def test_logic_variable():
     assert rt.unify(z, (1, 1))
 
 
+def test_fresh_vars():
+    store = rt.BuiltInStore()
+    x = store.fresh('x')
+    y = store.fresh('x')
+    z = store.fresh('x')
+    assert (x.name, y.name, z.name) == ('x', 'x_1', 'x_2')
+    assert str(store.fresh(value=0)) == '_V3=0@3'
+
+    variables = store.fresh_vars(3)
+    assert [v.index for v in variables] == [4, 5, 6]
+    assert str(variables[0]) == '_V4@4'
+    assert rt.unify(variables, [1, 2, variables[0]])
+    assert variables == [1, 2, 1]
+    assert store.fresh().index == 7
+
+
 def test_occurs_check():
     store = rt.BuiltInStore()
     x = store.fresh('x')
     assert x.occurs_check(x)
     assert x.occurs_check((x,))
+
+    y = store.fresh('y')
+    z = store.fresh('z')
+    assert rt.unify(y, [1, {"a": z}])
+    assert not x.occurs_check(y)
+    assert rt.unify(x, z)
+    assert x.occurs_check(y)
+    assert not rt.unify(x, (1, y), occurs_check=True)
+    assert not x.is_bound()
+    assert rt.unify(x, (1, y))
+
+
+def test_intern_table():
+    table = rt.InternTable()
+    a = table.intern(("if", ("not", "x"), {"term": ["a", 1]}))
+    b = table.intern(("".join("if"), ("not", "".join("x")), {"term": ["a", 1]}))
+    assert a == b and a is b
+    assert table.intern((True,)) is not table.intern((1,))
+    assert type(table.intern([1.0])[0]) is float
+    assert str(table.intern((0.0,))[0]) == "0.0"
+    assert str(table.intern((-0.0,))[0]) == "-0.0"
+    assert str(table.intern([complex(-0.0, 1)])[0]) == str(complex(-0.0, 1))
+
+    store = rt.BuiltInStore()
+    x = store.fresh()
+    c = table.intern(("if", x, ("not", "x")))
+    assert c[1] is x and c[2] is a[1]
+
+    # nested deeper than the recursion limit
+    deep, equal_deep = (), ()
+    for i in range(10 * sys.getrecursionlimit()):
+        deep, equal_deep = (i, [deep]), (i, [equal_deep])
+    assert table.intern(deep) is table.intern(equal_deep)
+
+    chr_store = rt.CHRStore(intern=True)
+    for i in range(2 * rt.INTERN_TABLE_SIZE):
+        index = chr_store.new()
+        chr_store.insert(("c/1", (i, "a")), index)
+        if i % 2:
+            chr_store.delete(index)
+    # rebuilt from the live constraints
+    assert len(chr_store.intern_table) < 2 * rt.INTERN_TABLE_SIZE
+    (_, first), (_, second) = list(chr_store.get_iterator())[:2]
+    assert first[1][1] is second[1][1]
+
+
+def test_symbol_buckets():
+    store = rt.CHRStore()
+
+    a = store.new()
+    b = store.new()
+    c = store.new()
+
+    store.insert(("a/1", 1), a)
+    store.insert(("b/1", 2), b)
+    store.insert(("a/1", 3), c)
+
+    assert list(store.get_iterator(symbol="a/1")) == [(a, ("a/1", 1)), (c, ("a/1", 3))]
+    assert list(store.get_iterator(symbol="b/1")) == [(b, ("b/1", 2))]
+    assert not list(store.get_iterator(symbol="c/1"))
+
+    store.set_save_point()
+    store.delete(a)
+    assert list(store.get_iterator(symbol="a/1", fix=True)) == [(c, ("a/1", 3))]
+
+    store.backtrack()
+    assert (a, ("a/1", 1)) in store.get_iterator(symbol="a/1")
+
+
+def test_symbol_ids():
+    store = rt.CHRStore(indexes=[("b/2", (0,))], symbols=["a/1", "b/2"])
+
+    a = store.new()
+    b = store.new()
+    store.insert((0, 1), a)
+    store.insert((1, 2, 3), b)
+
+    assert list(store.get_iterator(symbol=0)) == [(a, (0, 1))]
+    assert list(store.get_iterator(symbol="b/2", index=(0,), key=(2,))) == [(b, (1, 2, 3))]
+    # dump returns the signatures
+    assert store.dump() == [("a/1", 1), ("b/2", 2, 3)]
+
+
+def test_hash_index():
+    builtin = rt.BuiltInStore()
+    builtin.set_save_point()
+    store = rt.CHRStore([("node/2", (0,))])
+    x = builtin.fresh()
+
+    a, b, c, d = store.new(), store.new(), store.new(), store.new()
+    store.insert(("node/2", 1, "a"), a)
+    store.insert(("node/2", 2, "b"), b)
+    store.insert(("node/2", x, "c"), c)
+
+    def lookup(key):
+        return [i for i, _ in store.get_iterator(symbol="node/2", fix=True, index=(0,), key=(key,))]
+
+    # constraints with variables at indexed positions are always candidates
+    assert lookup(1) == [a, c]
+    assert lookup(2) == [b, c]
+    assert lookup(3) == [c]
+    # unbound keys only visit constraints with variables of the same class
+    assert lookup(x) == [c]
+
+    store.set_save_point()
+    store.delete(a)
+    store.insert(("node/2", 1, "d"), d)
+    assert lookup(1) == [c, d]
+
+    store.backtrack()
+    assert lookup(1) == [a, c]
+    assert (1,) in store.indexes["node/2"][(0,)].ground
+
+
+def test_get_single():
+    builtin = rt.BuiltInStore()
+    store = rt.CHRStore([("node/2", (0,))])
+    x = builtin.fresh()
+
+    a, b, c = store.new(), store.new(), store.new()
+    store.insert(("node/2", 1, "a"), a)
+    store.insert(("node/2", 2, "b"), b)
+    assert store.get_single("node/2", (0,), (2,)) == (b, ("node/2", 2, "b"))
+    assert store.get_single("node/2", (0,), (3,)) == (None, None)
+    assert store.get_single("node/2", (0,), (1,), exclude=(a,)) == (None, None)
+    assert store.get_single("node/2") == (a, ("node/2", 1, "a"))
+
+    # candidates with variables at the key positions are only returned if equal to key
+    store.insert(("node/2", x, "c"), c)
+    assert store.get_single("node/2", (0,), (3,)) == (None, None)
+    assert store.get_single("node/2", (0,), (x,))[0] == c
+    assert store.get_single("node/2", (0,), (2,))[0] == b
+
+
+def test_variable_index_union():
+    builtin = rt.BuiltInStore()
+    builtin.set_save_point()
+    store = rt.CHRStore([("eq/2", (0,))])
+    x, y, z = builtin.fresh(), builtin.fresh(), builtin.fresh()
+
+    a, b, c = store.new(), store.new(), store.new()
+    store.insert(("eq/2", x, 1), a)
+    store.insert(("eq/2", y, 2), b)
+    store.insert(("eq/2", z, 3), c)
+
+    def lookup(key):
+        return [i for i, _ in store.get_iterator(symbol="eq/2", fix=True, index=(0,), key=(key,))]
+
+    assert lookup(x) == [a]
+    assert lookup(y) == [b]
+
+    assert rt.unify(x, y)
+    assert lookup(x) == [a, b]
+    assert lookup(y) == [a, b]
+    assert lookup(z) == [c]
+
+    assert rt.unify(z, x)
+    assert lookup(y) == [a, b, c]
+    assert sorted(builtin.get_class_members(x.index)) == [x.index, y.index, z.index]
+
+    builtin.reset_recent_bindings()
+    assert lookup(x) == [a]
+    assert lookup(y) == [b]
+    assert lookup(z) == [c]
+    assert not builtin.class_members
+
+    # variables bound after insertion are candidates for ground keys
+    assert rt.unify(y, 5)
+    assert b in lookup(5)
+
+
+def test_iteration_during_updates():
+    store = rt.CHRStore()
+
+    ids = [store.new() for _ in range(20)]
+    for i in ids:
+        store.insert(("a/1", i), i)
+
+    visited = []
+    for i, _ in store.get_iterator(symbol="a/1"):
+        visited.append(i)
+        # deleting constraints ahead, and inserting new ones, while iterating
+        if i + 1 in store.constraints:
+            store.delete(i + 1)
+        new_id = store.new()
+        store.insert(("a/1", new_id), new_id)
+
+    assert visited == ids[::2]
+    assert len(list(store.get_iterator(symbol="a/1"))) == 10 + 10
+
+
+def test_history_collection():
+    store = rt.CHRStore()
+
+    a, b, c = store.new(), store.new(), store.new()
+    for i in (a, b, c):
+        store.insert(("a/0",), i)
+
+    assert store.add_to_history(0, (a, b))
+    assert store.add_to_history(0, (b, c))
+    assert store.add_to_history(1, c)
+    assert not store.add_to_history(0, (a, b))
+    assert store.history_size() == 3
+
+    store.set_save_point()
+    store.delete(b)
+    store.collect_history()
+    assert store.history_size() == 1
+    assert not store.in_history(0, (a, b))
+    assert store.in_history(1, c)
+
+    store.backtrack()
+    assert store.history_size() == 3
+    assert store.in_history(0, (a, b))
+    assert store.in_history(0, (b, c))
+
+
+def test_alive_compaction():
+    store = rt.CHRStore()
+
+    survivor = store.new()
+    store.insert(("a/0",), survivor)
+    for _ in range(10 * rt.ALIVE_WINDOW_SIZE):
+        index = store.new()
+        store.insert(("a/0",), index)
+        store.delete(index)
+
+    assert len(store.alive_flags) <= 2 * rt.ALIVE_WINDOW_SIZE + 1
+    assert store.alive(survivor)
+    assert not store.alive(index)
+    assert not store.alive(survivor + 1)
+
+    store.set_save_point()
+    store.delete(survivor)
+    assert not store.alive(survivor)
+    store.backtrack()
+    assert store.alive(survivor)
+
+
+def test_columnar_bucket():
+    store = rt.CHRStore(columnar=["n/2"])
+    builtin = rt.BuiltInStore()
+    x = builtin.fresh()
+
+    ids = [store.new() for _ in range(6)]
+    for i in ids:
+        store.insert(("n/2", i, 10 * i), i)
+    store.delete(ids[1])
+    v = store.new()
+    store.insert(("n/2", x, 1), v)
+
+    bucket = store.buckets["n/2"]
+    assert len(bucket) == 6
+    assert len(bucket.overflow) == 1
+    assert store.constraints[ids[0]] is bucket
+    assert store.get_constraint(ids[2]) == ("n/2", 2, 20)
+    assert ("n/2", x, 1) in store.dump()
+
+    visited = []
+    for i, c in store.get_iterator(symbol="n/2"):
+        visited.append(c)
+        if i + 1 in store.constraints:
+            store.delete(i + 1)
+    assert [c[1] for c in visited[:-1]] == [0, 2, 4]
+    assert visited[-1][1] is x
+
+    store.set_save_point()
+    store.delete(ids[0])
+    ids_column, (first, second) = store.export("n/2")
+    assert list(ids_column) == [ids[2], ids[4]]
+    assert list(first) == [2, 4] and list(second) == [20, 40]
+    ids_column, (first, second) = store.select("n/2", 1, ">=", 40)
+    assert list(ids_column) == [ids[4]]
+    assert list(first) == [4] and list(second) == [40]
+    store.backtrack()
+    assert list(store.export("n/2")[0]) == [ids[0], ids[2], ids[4]]
+
+
+def test_union_find_backtracking():
+    from random import Random
+
+    random = Random(0)
+    store = rt.BuiltInStore()
+    xs = [store.fresh() for _ in range(200)]
+
+    def partition():
+        return [store.find(x.index) for x in xs]
+
+    snapshots = []
+    for _ in range(10):
+        store.set_save_point()
+        snapshots.append(partition())
+        for _ in range(30):
+            a, b = random.sample(xs, 2)
+            assert rt.unify(a, b)
+            store.find(random.choice(xs).index)
+        store.commit_recent_bindings()
+
+    def depth(index):
+        d = 0
+        while store.union_find[index] != index:
+            index = store.union_find[index]
+            d += 1
+        return d
+
+    # union by size keeps the trees shallow
+    assert max(depth(x.index) for x in xs) <= 8
+
+    while snapshots:
+        store.backtrack()
+        expected = snapshots.pop()
+        # same classes, i.e. equal representatives at the same positions
+        actual = partition()
+        assert all(
+            (expected[i] == expected[j]) == (actual[i] == actual[j])
+            for i in range(len(xs)) for j in range(i)
+        )
+
+
+def test_suspensions():
+    builtin = rt.BuiltInStore()
+    store = rt.CHRStore(builtin=builtin)
+    x, y = builtin.fresh(), builtin.fresh()
+
+    calls = []
+
+    def activate(index, positions, *args):
+        calls.append((index, positions))
+
+    a, b = store.new(), store.new()
+    store.insert(("c/2", x, y), a)
+    store.suspend(a, activate, (x, y))
+    store.insert(("c/1", x), b)
+    store.suspend(b, activate, (x,))
+
+    # one wakeup per constraint, though both of its variables are bound
+    builtin.set_save_point()
+    assert rt.unify(x, y)
+    assert rt.unify(y, 1)
+    builtin.commit_recent_bindings()
+    assert calls == [(a, 0b11), (b, 0b1)]
+
+    store.set_save_point()
+    store.delete(b)
+    assert b not in builtin.suspensions
+    store.backtrack()
+    assert b in builtin.suspensions
+
+    # no wakeups for deleted constraints
+    z = builtin.fresh()
+    c = store.new()
+    store.insert(("c/1", z), c)
+    store.suspend(c, activate, (z,))
+    store.delete(c)
+    calls.clear()
+    assert rt.unify(z, 2)
+    builtin.commit_recent_bindings()
+    assert not calls
+    assert z.index not in builtin.delayed_calls